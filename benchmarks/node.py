@@ -0,0 +1,65 @@
+"""
+Memory and allocation benchmark for kademLAN.node.Node.
+
+Compares the slotted, binary-id Node against the previous plain class that
+kept a hex id in its __dict__, both for a large routing table's worth of
+contacts and for decoding the same find_node responses over and over.
+
+Run from the repository root with:
+
+    PYTHONPATH=. python benchmarks/node.py
+"""
+import os
+import random
+import time
+import tracemalloc
+
+from kademLAN.node import Node
+
+
+class LegacyNode:
+    def __init__(self, id_, ip=None, port=None):
+        self.id = id_
+        self.ip = ip
+        self.port = port
+        self.long_id = int(id_, 16)
+
+
+def measure(f):
+    """
+    Run f and return (result, bytes still allocated, blocks allocated, seconds).
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = f()
+    elapsed = time.perf_counter() - start
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = snapshot.statistics('filename')
+    return result, sum(s.size for s in stats), sum(s.count for s in stats), elapsed
+
+
+def report(name, legacy, current):
+    print("%-28s %12s %12s" % (name, "legacy", "slotted"))
+    print("%-28s %12i %12i" % ("  bytes held", legacy[1], current[1]))
+    print("%-28s %12i %12i" % ("  blocks held", legacy[2], current[2]))
+    print("%-28s %12.1f %12.1f" % ("  time (ms)", legacy[3] * 1e3, current[3] * 1e3))
+
+
+def main(contacts=100000, peers=200, responses=5000, ksize=20):
+    # each class holds its own id representation: hex text or raw bytes
+    rawids = [os.urandom(20) for _ in range(contacts)]
+    legacy = measure(lambda: [LegacyNode(r.hex(), '10.0.0.1', 8468) for r in rawids])
+    current = measure(lambda: [Node(r, '10.0.0.1', 8468) for r in rawids])
+    report("%i contacts" % contacts, legacy, current)
+
+    # a busy node hears about the same few hundred peers in every response
+    network = [(os.urandom(20).hex(), '10.0.%i.%i' % (i // 256, i % 256), 8468) for i in range(peers)]
+    wire = [random.sample(network, ksize) for _ in range(responses)]
+    legacy = measure(lambda: [[LegacyNode(*c) for c in r] for r in wire])
+    current = measure(lambda: [[Node.intern(*c) for c in r] for r in wire])
+    report("%i find_node responses" % responses, legacy, current)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Microbenchmark for the per-RPC routing cost of a growing routing table.
+
+Every inbound RPC calls RoutingTable.addContact, which has to resolve the
+bucket the sender falls into.  This grows tables to hundreds of buckets and
+compares the bisect lookup against the old linear scan over the buckets.
+
+Run with:
+
+    PYTHONPATH=. python benchmarks/routing.py
+"""
+import random
+import timeit
+
+from kademLAN.node import Node
+from kademLAN.routing import RoutingTable
+
+
+def linearBucketFor(table, node):
+    for index, bucket in enumerate(table.buckets):
+        if node.long_id <= bucket.range[1]:
+            return index
+
+
+def randomNode():
+    return Node('%040x' % random.getrandbits(160), '127.0.0.1', random.randint(1024, 65535))
+
+
+def buildTable(nbuckets, ksize=8):
+    table = RoutingTable(None, ksize, randomNode())
+    # split the widest bucket until the table has the requested size; this
+    # is what a table looks like once it knows about a large network
+    while len(table.buckets) < nbuckets:
+        widest = max(range(len(table.buckets)), key=lambda i: table.buckets[i].range[1] - table.buckets[i].range[0])
+        table.splitBucket(widest)
+    return table
+
+
+def main(sizes=(1, 10, 50, 100, 200, 400, 800), rounds=20000):
+    print("%8s %14s %14s %8s" % ("buckets", "linear (us)", "bisect (us)", "speedup"))
+    for size in sizes:
+        table = buildTable(size)
+        nodes = [randomNode() for _ in range(1000)]
+        for node in nodes:
+            assert linearBucketFor(table, node) == table.getBucketFor(node)
+
+        linear = timeit.timeit(lambda: [linearBucketFor(table, n) for n in nodes], number=rounds // 1000)
+        bisected = timeit.timeit(lambda: [table.getBucketFor(n) for n in nodes], number=rounds // 1000)
+        perRPC = lambda t: t / rounds * 1e6
+        print("%8i %14.3f %14.3f %7.1fx" % (len(table.buckets), perRPC(linear), perRPC(bisected), linear / bisected))
+
+
+if __name__ == "__main__":
+    main()
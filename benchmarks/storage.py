@@ -0,0 +1,67 @@
+"""
+Throughput and restart benchmark for kademLAN.storage.LogStorage.
+
+Compares set and get throughput with the in-memory ForgetfulStorage, and
+times reopening a LogStorage both from its hint file and, as after a crash,
+from the log alone.  A ForgetfulStorage has nothing to reopen: after a
+restart its keys have to be re-replicated from the network.
+
+Run from the repository root with:
+
+    PYTHONPATH=. python benchmarks/storage.py
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from kademLAN.storage import ForgetfulStorage, LogStorage
+from kademLAN.utils import digest
+
+
+def timed(f):
+    start = time.perf_counter()
+    result = f()
+    return result, time.perf_counter() - start
+
+
+def fill(storage, keys, value):
+    for key in keys:
+        storage[key] = value
+
+
+def readAll(storage, keys):
+    for key in keys:
+        storage[key]
+
+
+def main(count=100000, size=100):
+    keys = [digest(i) for i in range(count)]
+    value = 'x' * size
+    directory = tempfile.mkdtemp()
+    try:
+        memory = ForgetfulStorage()
+        log = LogStorage(directory)
+        print("%-28s %12s %12s" % ("%i keys of %i bytes" % (count, size), "memory", "log"))
+        _, memorySet = timed(lambda: fill(memory, keys, value))
+        _, logSet = timed(lambda: fill(log, keys, value))
+        print("%-28s %12i %12i" % ("  sets per second", count / memorySet, count / logSet))
+        _, memoryGet = timed(lambda: readAll(memory, keys))
+        _, logGet = timed(lambda: readAll(log, keys))
+        print("%-28s %12i %12i" % ("  gets per second", count / memoryGet, count / logGet))
+
+        log.close()
+        log, withHints = timed(lambda: LogStorage(directory))
+        os.close(log.fd)
+        os.remove(os.path.join(directory, 'data.hint'))
+        log, fromLog = timed(lambda: LogStorage(directory))
+        assert len(list(log)) == count
+        log.close()
+        print("%-28s %12s %12.1f" % ("  restart, hints (ms)", "-", withHints * 1e3))
+        print("%-28s %12s %12.1f" % ("  restart, log only (ms)", "-", fromLog * 1e3))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Size and decoding benchmark for find_node responses.
+
+Compares the hex (id, ip, port) tuples older peers send with the compact
+encoding from kademLAN.wire that version 3 peers use, by packed size and
+by the time RPCFindResponse.getNodeList takes to turn them into Nodes.
+
+Run from the repository root with:
+
+    PYTHONPATH=. python benchmarks/wire.py
+"""
+import os
+import time
+
+import umsgpack
+
+from kademLAN.crawling import RPCFindResponse
+from kademLAN.node import Node
+from kademLAN.wire import packContacts
+
+
+def decode(responses):
+    start = time.perf_counter()
+    for response in responses:
+        RPCFindResponse((True, umsgpack.unpackb(response))).getNodeList()
+    return time.perf_counter() - start
+
+
+def main(responses=20000, ksize=20):
+    nodes = [Node(os.urandom(20), '10.0.%i.%i' % (i // 256, i % 256), 8468) for i in range(ksize)]
+    hexed = umsgpack.packb([(n.id.hex(), n.ip, n.port) for n in nodes])
+    compact = umsgpack.packb(packContacts(nodes))
+
+    print("%-28s %12s %12s" % ("k=%i find_node response" % ksize, "hex", "compact"))
+    print("%-28s %12i %12i" % ("  bytes", len(hexed), len(compact)))
+    print("%-28s %12.1f %12.1f" % ("  decode %i (ms)" % responses,
+                                   decode([hexed] * responses) * 1e3,
+                                   decode([compact] * responses) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
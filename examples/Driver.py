@@ -1,4 +1,4 @@
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.python import log
 from kademLAN.network import Server
 import pickle
@@ -74,11 +74,9 @@ def driveFromFile(drivePath, server, results, stab_t, runtime):
     # Some stabilization time
     time.sleep(stab_t)
 
-    for event in driveList:
-        key = event[0]
-        server.set(key, key)
-        time.sleep(0.2)
-        print("Issued PUT at:{} for Key:{}".format(time.time(), key))
+    keys = [event[0] for event in driveList]
+    stored = threads.blockingCallFromThread(reactor, server.set_many, dict(zip(keys, keys)))
+    print("Issued PUT at:{} for Keys:{} stored:{}".format(time.time(), keys, stored))
 
     START_T = time.time()
     # for each event in list, do the action at the appropriate time
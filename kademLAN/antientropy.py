@@ -0,0 +1,316 @@
+"""
+Anti-entropy between replicas: instead of republishing every key on a
+timer, neighbors compare hashes over ranges of the id space and only send
+the keys in ranges that differ.
+"""
+import hashlib
+from bisect import bisect_left, bisect_right
+
+import umsgpack
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+
+from kademLAN.log import Logger
+from kademLAN.storage import keyID
+
+
+def idToWire(long_id):
+    # msgpack ints stop at 64 bits, so range ends go as 20 bytes
+    return long_id.to_bytes(20, 'big')
+
+
+def idFromWire(data):
+    if not isinstance(data, bytes) or len(data) != 20:
+        raise ValueError("not an id: %r" % (data,))
+    return int.from_bytes(data, 'big')
+
+
+def split(lower, upper, fanout):
+    """
+    Split the range lower..upper (inclusive) into fanout equal parts, or
+    into single ids if it's narrower than that.
+    """
+    width = upper - lower + 1
+    if width <= fanout:
+        return [(i, i) for i in range(lower, upper + 1)]
+    step = width // fanout
+    return [(lower + i * step, lower + (i + 1) * step - 1 if i < fanout - 1 else upper)
+            for i in range(fanout)]
+
+
+def validEntry(entry):
+    return (isinstance(entry, list) and len(entry) == 3 and isinstance(entry[0], str)
+            and isinstance(entry[1], int) and isinstance(entry[2], (int, float)))
+
+
+def newer(key, hashed, age, other):
+    """
+    Whether the value for key with the given hash and age should replace
+    what other, a C{dict} of key to (hash, age), has for it.  Ages count
+    from when a value was first written, which copies keep, so the value
+    written last wins however many times either has been copied since.
+    """
+    if key not in other:
+        return True
+    otherHash, otherAge = other[key]
+    return otherHash != hashed and age < otherAge
+
+
+class MerkleSnapshot(object):
+    """
+    Hashes of the stored keys in one id range, at one moment.
+
+    Each key hashes to 64 bits from its key and value.  The hash of any
+    subrange is the XOR of the hashes of the keys in it, which a running
+    XOR over the keys in id order gives with two bisects, so every level of
+    the tree comes from the one pass over storage.
+    """
+    def __init__(self, storage, lower, upper, now):
+        self.lower = lower
+        self.upper = upper
+        self.taken = now
+        self.ids = []
+        self.entries = []
+        self.xors = [0]
+        for key, birthday, value in storage.itertriplesInRange(lower, upper):
+            digest = hashlib.sha1(umsgpack.packb([key, value])).digest()
+            hashed = int.from_bytes(digest[:8], 'big')
+            self.ids.append(keyID(key))
+            self.entries.append((key, hashed, birthday))
+            self.xors.append(self.xors[-1] ^ hashed)
+
+    def covers(self, lower, upper):
+        return self.lower <= lower and upper <= self.upper
+
+    def bounds(self, lower, upper):
+        return bisect_left(self.ids, lower), bisect_right(self.ids, upper)
+
+    def summary(self, lower, upper):
+        """
+        The number of keys in lower..upper and the hash over them.
+        """
+        lo, hi = self.bounds(lower, upper)
+        return hi - lo, self.xors[hi] ^ self.xors[lo]
+
+    def entriesIn(self, lower, upper, now):
+        """
+        (key, hash, age at now) for each key in lower..upper.
+        """
+        lo, hi = self.bounds(lower, upper)
+        return [(key, hashed, now - birthday) for key, hashed, birthday in self.entries[lo:hi]]
+
+
+class AntiEntropy(object):
+    """
+    Keeps this node's keys in step with its neighbors'.
+
+    Every interval seconds one of the k nodes closest to us, taken in turn,
+    is compared with over the range of ids we're responsible for.  Ranges
+    whose key counts and hashes agree are skipped; those that don't are
+    split fanout ways and compared again, until they hold few enough keys
+    to list.  Keys are then sent to the neighbor if it should hold them
+    and has an older value or none, and fetched from it for the keys we
+    should hold.  A session stops once it has moved about budget bytes, and
+    the rest is left to later ones.
+    """
+    def __init__(self, protocol, ksize, interval=600, budget=262144, fanout=16,
+                 leafSize=64, snapshotAge=60, clock=None):
+        """
+        Args:
+            protocol: A :class:`~kademLAN.protocol.KademliaProtocol` instance.
+            ksize: The value for k based on the paper
+            interval: Seconds between sessions.
+            budget: Roughly the most bytes one session sends and receives.
+            fanout: How many ways a range that differs is split.
+            leafSize: Ranges with no more keys than this on either side are
+                      compared key by key.
+            snapshotAge: Seconds a snapshot of our hashes is reused for.
+        """
+        self.protocol = protocol
+        self.ksize = ksize
+        self.interval = interval
+        self.budget = budget
+        self.fanout = fanout
+        self.leafSize = leafSize
+        self.snapshotAge = snapshotAge
+        self.clock = clock or reactor
+        self.snapshots = []
+        self.turn = 0
+        self.session = None
+        self.loop = None
+        self.spent = 0
+        self.pushed = 0
+        self.pulled = 0
+        self.log = Logger(system=self)
+
+    def start(self):
+        self.loop = LoopingCall(self.runSession)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+    def snapshot(self, lower, upper):
+        now = self.clock.seconds()
+        self.snapshots = [s for s in self.snapshots if s.taken > now - self.snapshotAge]
+        for snapshot in self.snapshots:
+            if snapshot.covers(lower, upper):
+                return snapshot
+        snapshot = MerkleSnapshot(self.protocol.storage, lower, upper, now)
+        self.snapshots = self.snapshots[-3:] + [snapshot]
+        return snapshot
+
+    def nearest(self, long_id):
+        return self.protocol.router.index.nearest(long_id, self.ksize)
+
+    def responsibleRange(self):
+        """
+        The smallest aligned range of ids around us that holds every key we
+        can be one of the k closest nodes to.
+        """
+        me = self.protocol.sourceNode
+        neighbors = self.nearest(me.long_id)
+        if len(neighbors) < self.ksize:
+            return 0, 2 ** 160 - 1
+        span = 2 ** neighbors[-1].distanceTo(me).bit_length()
+        lower = me.long_id - me.long_id % span
+        return lower, min(lower + span, 2 ** 160) - 1
+
+    def shouldHold(self, node, key):
+        """
+        Whether node is one of the k closest nodes we know of (counting
+        ourselves) to key.
+        """
+        long_id = keyID(key)
+        if long_id is None:
+            return False
+        distances = [n.long_id ^ long_id for n in self.nearest(long_id)]
+        distances.append(self.protocol.sourceNode.long_id ^ long_id)
+        distances.sort()
+        return node.long_id ^ long_id <= distances[min(self.ksize, len(distances)) - 1]
+
+    def summaries(self, lower, upper, fanout):
+        """
+        The count and hash of each of the fanout parts of lower..upper.
+        """
+        snapshot = self.snapshot(lower, upper)
+        return [snapshot.summary(lo, hi) for lo, hi in split(lower, upper, fanout)]
+
+    def entries(self, lower, upper, limit):
+        return self.snapshot(lower, upper).entriesIn(lower, upper, self.clock.seconds())[:limit]
+
+    def runSession(self):
+        """
+        Compare with the next of our closest neighbors, unless a session is
+        still going.
+        """
+        if self.session is not None:
+            return self.session
+        neighbors = self.nearest(self.protocol.sourceNode.long_id)
+        if len(neighbors) == 0:
+            return defer.succeed(None)
+        node = neighbors[self.turn % len(neighbors)]
+        self.turn += 1
+
+        def failed(failure):
+            self.log.warning("anti-entropy with %s failed: %s" % (node, failure.getErrorMessage()))
+
+        def done(_):
+            self.session = None
+        self.session = self.syncWith(node).addErrback(failed).addBoth(done)
+        return self.session
+
+    def syncWith(self, node):
+        def start(version):
+            if version < 5:
+                return None
+            self.spent = 0
+            return self.compare(node, [self.responsibleRange()])
+        return self.protocol.callVersion(node).addCallback(start)
+
+    def compare(self, node, ranges):
+        """
+        Work through ranges with node one at a time, until they or the
+        budget run out.
+        """
+        if len(ranges) == 0 or self.spent >= self.budget:
+            return defer.succeed(None)
+        lower, upper = ranges.pop()
+        d = self.protocol.callMerkleSummaries(node, lower, upper, self.fanout)
+        return d.addCallback(self.compareSummaries, node, lower, upper, ranges)
+
+    def compareSummaries(self, result, node, lower, upper, ranges):
+        if not result[0] or not isinstance(result[1], list):
+            return None
+        parts = split(lower, upper, self.fanout)
+        if len(result[1]) != len(parts):
+            return None
+        self.spent += len(umsgpack.packb(result[1]))
+        snapshot = self.snapshot(lower, upper)
+        leaves = []
+        for (lo, hi), theirs in zip(parts, result[1]):
+            ours = snapshot.summary(lo, hi)
+            if list(ours) == list(theirs):
+                continue
+            if lo == hi or max(ours[0], theirs[0]) <= self.leafSize:
+                leaves.append((lo, hi))
+            else:
+                ranges.append((lo, hi))
+
+        def nextLeaf(_):
+            if len(leaves) == 0 or self.spent >= self.budget:
+                return self.compare(node, ranges)
+            lo, hi = leaves.pop()
+            return self.exchange(node, lo, hi).addCallback(nextLeaf)
+        return nextLeaf(None)
+
+    def exchange(self, node, lower, upper):
+        """
+        List the keys in a differing range on both sides, and send and
+        fetch whichever the other side is missing or has older.
+        """
+        d = self.protocol.callMerkleEntries(node, lower, upper, self.leafSize)
+
+        def reconcile(result):
+            if not result[0] or not isinstance(result[1], list):
+                return None
+            self.spent += len(umsgpack.packb(result[1]))
+            theirs = dict((entry[0], tuple(entry[1:])) for entry in result[1] if validEntry(entry))
+            ours = dict((key, (hashed, age)) for key, hashed, age in self.snapshot(lower, upper).entriesIn(lower, upper, self.clock.seconds()))
+            push, pull = {}, []
+            for key, (hashed, age) in ours.items():
+                if newer(key, hashed, age, theirs):
+                    value = self.protocol.storage.get(key, None)
+                    if value is not None and self.shouldHold(node, key):
+                        push[key] = value
+            for key, (hashed, age) in theirs.items():
+                if newer(key, hashed, age, ours) and self.shouldHold(self.protocol.sourceNode, key):
+                    pull.append(key)
+            return self.transfer(node, push, pull)
+        return d.addCallback(reconcile)
+
+    def transfer(self, node, push, pull):
+        """
+        Send node the values in push and fetch those of the keys in pull.
+        Either way the copies keep the age and expiry of the original.
+        """
+        storage = self.protocol.storage
+        ds = []
+        if len(push) > 0:
+            self.spent += len(umsgpack.packb(list(push.items())))
+            self.pushed += len(push)
+            times = dict((key, storage.timesFor(key)) for key in push)
+            ds.append(self.protocol.callStoreMany(node, push, times=times))
+        if len(pull) > 0:
+            times = {}
+
+            def store(values):
+                self.spent += len(umsgpack.packb(list(values.items())))
+                self.pulled += len(values)
+                for key, value in values.items():
+                    age, ttl = times.get(key, (None, None))
+                    storage.set(key, value, ttl, age)
+            ds.append(self.protocol.callFindValues(node, pull, times).addCallback(store))
+        return defer.gatherResults(ds)
@@ -0,0 +1,202 @@
+"""
+Peer discovery over UDP broadcast, run on the reactor.
+
+This speaks the same ZRE beacon format as :class:`~kademLAN.discovery.Discover`,
+so nodes using either can find each other, but needs neither zmq nor a
+thread of its own.
+"""
+import struct
+import uuid
+
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import LoopingCall
+
+from kademLAN.log import Logger
+
+BEACON_VERSION = 1
+ZRE_DISCOVERY_PORT = 5670
+REAP_INTERVAL = 10.0
+PEER_EXPIRY = 30.0
+
+# 'ZRE', version, sender's uuid and its port in network order
+BEACON = struct.Struct('!3sB16sH')
+
+# appended to the ZRE beacon by kademLAN nodes that are given a node id to
+# announce: a tag, the sender's node id and the protocol version it speaks,
+# so that it can go straight into the routing table of whoever hears it.
+# Older Discover threads unpack beacons as exactly 22 bytes and die on
+# anything longer, so this is off unless asked for.
+EXTENSION = struct.Struct('!c20sB')
+EXTENSION_TAG = b'K'
+
+
+def packBeacon(identity, port, nodeID=None, version=1):
+    data = BEACON.pack(b'ZRE', BEACON_VERSION, identity.bytes, port)
+    if nodeID is not None:
+        data += EXTENSION.pack(EXTENSION_TAG, nodeID, version)
+    return data
+
+
+def unpackBeacon(data):
+    """
+    Decode a beacon into the sender's C{uuid.UUID}, port, node id and
+    protocol version.  The last two are None for a plain ZRE beacon.
+    Raises C{ValueError} if data isn't a ZRE beacon we understand.
+    """
+    if len(data) < BEACON.size:
+        raise ValueError("short beacon")
+    header, version, identity, port = BEACON.unpack_from(data)
+    if header != b'ZRE' or version != BEACON_VERSION:
+        raise ValueError("not a version %i ZRE beacon" % BEACON_VERSION)
+    nodeID = protocolVersion = None
+    if len(data) >= BEACON.size + EXTENSION.size:
+        tag, nodeID, protocolVersion = EXTENSION.unpack_from(data, BEACON.size)
+        if tag != EXTENSION_TAG:
+            nodeID = protocolVersion = None
+    return uuid.UUID(bytes=identity), port, nodeID, protocolVersion
+
+
+class BeaconDiscover(DatagramProtocol):
+    """
+    Broadcasts a beacon every interval seconds and listens for others'.
+
+    It has the same interface as :class:`~kademLAN.discovery.Discover` and
+    can be passed to :class:`~kademLAN.network.Server` in its place.  Any
+    number of instances can listen at once, in one process or several, since
+    the beacon port is bound for shared use.
+    """
+    def __init__(self, port=8080, peerJoined=None, peerLeft=None, interval=1.0,
+                 address='255.255.255.255', beaconPort=ZRE_DISCOVERY_PORT, expiry=PEER_EXPIRY,
+                 nodeID=None, version=1, clock=None):
+        """
+        Args:
+            port: The port our node listens on, which the beacon announces.
+            peerJoined: Called with a peer's (ip, port), node id and protocol
+                        version when its first beacon is heard.  The id and
+                        version are None if the beacon didn't carry them.
+            peerLeft: Called with a peer's (ip, port) when it says it's
+                      going away, or goes silent for expiry seconds.
+            interval: Seconds between beacons.
+            address: Where beacons are sent; a broadcast address, or a
+                     multicast group to join.
+            beaconPort: The UDP port beacons are sent to and heard on.
+            expiry: Seconds without a beacon after which a peer is taken to
+                    have left, and peerLeft is called for it.
+            nodeID: Our node id, as bytes, to announce in our beacons.  If
+                    None, plain ZRE beacons are sent.
+            version: The protocol version to announce along with nodeID.
+        """
+        self.port = port
+        self.peerJoined = peerJoined
+        self.peerLeft = peerLeft
+        self.interval = interval
+        self.address = address
+        self.beaconPort = beaconPort
+        self.expiry = expiry
+        self.nodeID = nodeID
+        self.version = version
+        self.clock = clock or reactor
+        self.identity = uuid.uuid4()
+        self.peers = {}
+        self.lastSeen = {}
+        self.listening = None
+        self.loop = None
+        self.reaper = None
+        self.log = Logger(system=self)
+
+    def isMulticast(self):
+        first = int(self.address.split('.')[0])
+        return 224 <= first <= 239
+
+    def start(self):
+        self.listening = reactor.listenMulticast(self.beaconPort, self, listenMultiple=True)
+        self.loop = LoopingCall(self.publish)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval)
+        self.reaper = LoopingCall(self.reap)
+        self.reaper.clock = self.clock
+        self.reaper.start(REAP_INTERVAL, now=False)
+
+    def startProtocol(self):
+        self.transport.setBroadcastAllowed(True)
+        if self.isMulticast():
+            self.transport.joinGroup(self.address)
+
+    def stop(self):
+        """
+        Stop beaconing, telling the others we're going away.
+        """
+        for loop in (self.loop, self.reaper):
+            if loop is not None and loop.running:
+                loop.stop()
+        if self.listening is None:
+            return
+        self.send(packBeacon(self.identity, 0))
+        self.listening.stopListening()
+        self.listening = None
+
+    def publish(self):
+        self.send(packBeacon(self.identity, self.port, self.nodeID, self.version))
+
+    def send(self, data):
+        try:
+            self.transport.write(data, (self.address, self.beaconPort))
+        except OSError as e:
+            # no route to the broadcast address yet, say; try next time
+            self.log.debug("could not send beacon: %s" % e)
+
+    def datagramReceived(self, data, addr):
+        try:
+            identity, port, nodeID, version = unpackBeacon(data)
+        except ValueError:
+            return
+        if identity == self.identity:
+            return
+        if port:
+            self.require_peer(identity, (addr[0], port), nodeID, version)
+        elif identity in self.peers:
+            self.log.debug("peer %s is going away" % (self.peers[identity],))
+            self.remove_peer(identity)
+
+    def require_peer(self, identity, endpoint, nodeID=None, version=None):
+        """
+        Record a peer, and tell peerJoined if it's new.  Returns the peer's
+        endpoint as previously known, if it was.
+
+        A peer that restarts at the same endpoint comes back with a new
+        identity.  The old identity is dropped without calling peerLeft,
+        since the endpoint hasn't gone away; peerJoined is called for the
+        new one.
+        """
+        self.lastSeen[identity] = self.clock.seconds()
+        p = self.peers.get(identity)
+        if not p:
+            for other, known in list(self.peers.items()):
+                if known == endpoint:
+                    self.peers.pop(other)
+                    self.lastSeen.pop(other, None)
+            self.peers[identity] = endpoint
+            if self.peerJoined is not None:
+                self.peerJoined(endpoint, nodeID, version)
+        return p
+
+    def reap(self):
+        """
+        Drop the peers that have gone silent for longer than the expiry;
+        they went away without saying so.
+        """
+        cutoff = self.clock.seconds() - self.expiry
+        for identity, seen in list(self.lastSeen.items()):
+            if seen < cutoff:
+                self.log.debug("peer %s went silent" % (self.peers[identity],))
+                self.remove_peer(identity)
+
+    def get_peers(self):
+        return list(self.peers.values())
+
+    def remove_peer(self, identity):
+        endpoint = self.peers.pop(identity)
+        self.lastSeen.pop(identity, None)
+        if self.peerLeft is not None:
+            self.peerLeft(endpoint)
@@ -0,0 +1,136 @@
+"""
+Scheduling of the self-lookups that join newly discovered peers to our
+view of the network.
+"""
+from twisted.internet import reactor
+
+from kademLAN.log import Logger
+from kademLAN.node import Node
+from kademLAN.crawling import NodeSpiderCrawl
+
+
+class BootstrapScheduler(object):
+    """
+    Turns a stream of discovered peers into as few lookups of our own id as
+    it can.
+
+    Peers are gathered for delay seconds and then handled together.  Those
+    whose ids aren't known yet are pinged.  Only one lookup runs at a time;
+    peers found while it's running are folded into it instead of starting
+    another.  Once a lookup finishes, the next one waits at least interval
+    seconds.  The wait doubles after each lookup that leaves the routing
+    table healthy, up to maxInterval, and drops back to minInterval
+    otherwise.  Peers found during the wait still go into the routing table
+    straight away.
+    """
+    def __init__(self, protocol, ksize, alpha, callback=None, delay=0.5, minInterval=5,
+                 maxInterval=600, clock=None):
+        """
+        Args:
+            protocol: A :class:`~kademLAN.protocol.KademliaProtocol` instance.
+            ksize: The value for k based on the paper
+            alpha: The value for alpha based on the paper
+            callback: Called with the nodes found by each lookup.
+            delay: Seconds to gather peers for before handling them.
+            minInterval: The shortest wait in seconds between lookups.
+            maxInterval: The longest wait in seconds between lookups.
+        """
+        self.protocol = protocol
+        self.ksize = ksize
+        self.alpha = alpha
+        self.callback = callback
+        self.delay = delay
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.interval = minInterval
+        self.clock = clock or reactor
+        self.queued = []
+        self.flushing = None
+        self.crawl = None
+        self.due = False
+        self.nextLookup = 0
+        self.waiting = None
+        self.lookups = 0
+        self.folded = 0
+        self.log = Logger(system=self)
+
+    def add(self, peer):
+        """
+        Queue a discovered peer: an (ip, port) pair, or a
+        :class:`~kademLAN.node.Node` if its id is already known, in which
+        case it's added to the routing table now.
+        """
+        if isinstance(peer, Node):
+            self.protocol.welcomeNode(peer)
+        self.queued.append(peer)
+        if self.flushing is None:
+            self.flushing = self.clock.callLater(self.delay, self.flush)
+
+    def discard(self, address):
+        """
+        Forget a queued peer at address, which has since left.
+        """
+        # (ip, port) pairs and Nodes have the address as their last two fields
+        self.queued = [p for p in self.queued if tuple(p)[-2:] != address]
+
+    def flush(self):
+        self.flushing = None
+        if self.protocol.transport is None:
+            # not listening yet
+            self.flushing = self.clock.callLater(1, self.flush)
+            return
+        peers, self.queued = self.queued, []
+        nodes = [p for p in peers if isinstance(p, Node)]
+        if len(nodes) > 0:
+            self.lookup(nodes)
+        for addr in peers:
+            if not isinstance(addr, Node):
+                self.protocol.ping(addr, self.protocol.sourceNode.id.hex()).addCallback(self.pinged, addr)
+
+    def pinged(self, result, addr):
+        if result[0]:
+            node = Node.intern(result[1], addr[0], addr[1])
+            self.protocol.welcomeNode(node)
+            self.lookup([node])
+
+    def lookup(self, nodes):
+        """
+        Look up our own id starting from nodes, folding them into the lookup
+        that's running if there is one.
+        """
+        if self.crawl is not None and self.crawl.addPeers(nodes):
+            self.folded += len(nodes)
+            return
+        wait = self.nextLookup - self.clock.seconds()
+        if wait > 0:
+            # they're in the routing table, and the next lookup starts there
+            self.due = True
+            if self.waiting is None:
+                self.waiting = self.clock.callLater(wait, self.wake)
+            return
+        self.due = False
+        source = self.protocol.sourceNode
+        peers = nodes + self.protocol.router.findNeighbors(source, self.alpha)
+        self.crawl = NodeSpiderCrawl(self.protocol, source, peers, self.ksize, self.alpha)
+        self.lookups += 1
+        self.crawl.find().addCallback(self.finished)
+
+    def wake(self):
+        self.waiting = None
+        if self.due:
+            self.lookup([])
+
+    def isHealthy(self):
+        return len(self.protocol.router.index) >= self.ksize
+
+    def finished(self, found):
+        self.crawl = None
+        if self.isHealthy():
+            self.interval = min(self.interval * 2, self.maxInterval)
+        else:
+            self.interval = self.minInterval
+        self.nextLookup = self.clock.seconds() + self.interval
+        if self.due and self.waiting is None:
+            self.waiting = self.clock.callLater(self.interval, self.wake)
+        if self.callback is not None:
+            self.callback(found)
@@ -1,8 +1,31 @@
 from collections import Counter
 
+from twisted.internet import defer, reactor
+
 from kademLAN.log import Logger
-from kademLAN.utils import deferredDict
 from kademLAN.node import Node, NodeHeap
+from kademLAN.wire import unpackContacts
+
+
+class HedgePolicy(object):
+    """
+    Governs when a value lookup hedges a slow find_value call by sending
+    the same query to the next closest candidate, and counts how often
+    that happened and how often the hedge answered first.
+    """
+    def __init__(self, percentile=95, budget=2):
+        """
+        Args:
+            percentile: A call that has been outstanding for longer than
+                        this percentile of recently observed RPC round trip
+                        times gets hedged.
+            budget: The most hedges a single lookup may send.  Zero turns
+                    hedging off.
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.fired = 0
+        self.won = 0
 
 
 class SpiderCrawl(object):
@@ -24,12 +47,27 @@ class SpiderCrawl(object):
         self.ksize = ksize
         self.alpha = alpha
         self.node = node
-        self.nearest = NodeHeap(self.node, self.ksize)
-        self.lastIDsCrawled = []
+        self.nearest = NodeHeap(self.node, self.ksize, self.alpha)
+        self.inflight = {}
+        self.finished = False
+        self.result = defer.Deferred()
+        self.pumping = False
         self.log = Logger(system=self)
         self.log.info("creating spider with peers: %s" % peers)
         self.nearest.push(peers)
 
+    def addPeers(self, peers):
+        """
+        Fold more entry points into a crawl that's already running, so they
+        are queried along with the rest rather than by a crawl of their own.
+
+        Returns False if the crawl has already finished.
+        """
+        if self.finished:
+            return False
+        self.nearest.push(peers)
+        self._pump()
+        return True
 
     def _find(self, rpcmethod):
         """
@@ -39,34 +77,119 @@ class SpiderCrawl(object):
             rpcmethod: The protocol's callfindValue or callFindNode.
 
         The process:
-          1. calls find_* to current ALPHA nearest not already queried nodes,
-             adding results to current nearest list of k nodes.
-          2. current nearest list needs to keep track of who has been queried already
-             sort by nearest, keep KSIZE
-          3. if list is same as last time, next call should be to everyone not
-             yet queried
-          4. repeat, unless nearest list has all been queried, then ur done
+          1. keep ALPHA find_* calls in flight to the nearest nodes not
+             already queried, starting a new one as soon as any call
+             answers or times out, rather than in lockstep rounds.
+          2. each answer is merged into the current nearest list of k
+             nodes; nodes that don't answer are dropped from it.
+          3. stop once every one of the k nearest nodes has been queried
+             and none of them has a call still outstanding.
         """
+        self.rpcmethod = rpcmethod
         self.log.info("crawling with nearest: %s" % str(tuple(self.nearest)))
-        count = self.alpha
-        if self.nearest.getIDs() == self.lastIDsCrawled:
-            self.log.info("last iteration same as current - checking all in list now")
-            count = len(self.nearest)
-        self.lastIDsCrawled = self.nearest.getIDs()
+        self._pump()
+        return self.result
+
+    def _pump(self):
+        """
+        Fill the window of outstanding calls back up to alpha, or finish the
+        crawl if it has converged.  Calls that answer synchronously only
+        update state here; this loop picks up whatever they add.
+        """
+        if self.pumping:
+            return
+        self.pumping = True
+        try:
+            while not self.finished and len(self.inflight) < self.alpha:
+                uncontacted = self.nearest.getUncontacted()
+                if len(uncontacted) == 0:
+                    break
+                self._query(uncontacted[0])
+        finally:
+            self.pumping = False
+
+        if not self.finished and self.nearest.allResponded():
+            self._finish(self._notFound())
+
+    def _query(self, peer):
+        self.nearest.markContacted(peer)
+        self.inflight[peer.id] = peer
+        d = defer.maybeDeferred(self.rpcmethod, peer, self.node)
+        d.addBoth(self._responded, peer)
 
-        ds = {}
-        for peer in self.nearest.getUncontacted()[:count]:
-            ds[peer.id] = rpcmethod(peer, self.node)
-            self.nearest.markContacted(peer)
-        return deferredDict(ds).addCallback(self._nodesFound)
+    def _responded(self, result, peer):
+        self.inflight.pop(peer.id, None)
+        if self.finished:
+            return
+        if not isinstance(result, tuple):
+            result = (False, None)
+        self._handleResponse(peer, RPCFindResponse(result))
+        self._pump()
+
+    def _finish(self, result):
+        self.finished = True
+        defer.maybeDeferred(lambda: result).chainDeferred(self.result)
 
 
 class ValueSpiderCrawl(SpiderCrawl):
-    def __init__(self, protocol, node, peers, ksize, alpha):
+    def __init__(self, protocol, node, peers, ksize, alpha, hedging=None, cacheTime=86400):
+        """
+        Args:
+            hedging: An optional :class:`HedgePolicy` for hedging slow calls.
+            cacheTime: Seconds the nearest node without the value keeps the
+                       copy it's asked to cache, if no other node we know of
+                       is nearer the key.
+        """
         SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha)
         # keep track of the single nearest node without value - per
         # section 2.3 so we can set the key there if found
         self.nearestWithoutValue = NodeHeap(self.node, 1)
+        self.hedging = hedging
+        self.cacheTime = cacheTime
+        self.hedgesLeft = hedging.budget if hedging is not None else 0
+        # pending hedge timers by peer id, and the peer each hedge stands in for
+        self.hedgeTimers = {}
+        self.hedgeOf = {}
+        self.clock = reactor
+
+    def _query(self, peer):
+        SpiderCrawl._query(self, peer)
+        if self.hedgesLeft <= 0 or self.finished or peer.id not in self.inflight:
+            return
+        delay = self.protocol.rtt.percentile(self.hedging.percentile)
+        if delay is not None:
+            self.hedgeTimers[peer.id] = self.clock.callLater(delay, self._hedge, peer)
+
+    def _hedge(self, peer):
+        """
+        The call to peer is slower than we'd expect; ask the next closest
+        uncontacted candidate the same thing.  Whichever answers usefully
+        first is used.
+        """
+        del self.hedgeTimers[peer.id]
+        uncontacted = self.nearest.getUncontacted()
+        if self.hedgesLeft <= 0 or len(uncontacted) == 0:
+            return
+        self.hedgesLeft -= 1
+        self.hedging.fired += 1
+        self.hedgeOf[uncontacted[0].id] = peer.id
+        self._query(uncontacted[0])
+
+    def _responded(self, result, peer):
+        timer = self.hedgeTimers.pop(peer.id, None)
+        if timer is not None:
+            timer.cancel()
+        hedged = self.hedgeOf.pop(peer.id, None)
+        answered = isinstance(result, tuple) and result[0]
+        if hedged in self.inflight and answered and not self.finished:
+            self.hedging.won += 1
+        SpiderCrawl._responded(self, result, peer)
+
+    def _finish(self, result):
+        for timer in self.hedgeTimers.values():
+            timer.cancel()
+        self.hedgeTimers = {}
+        SpiderCrawl._finish(self, result)
 
     def find(self):
         """
@@ -74,30 +197,21 @@ class ValueSpiderCrawl(SpiderCrawl):
         """
         return self._find(self.protocol.callFindValue)
 
-    def _nodesFound(self, responses):
-        """
-        Handle the result of an iteration in _find.
-        """
-        toremove = []
-        foundValues = []
-        for peerid, response in list(responses.items()):
-            response = RPCFindResponse(response)
-            if not response.happened():
-                toremove.append(peerid)
-            elif response.hasValue():
-                foundValues.append(response.getValue())
-            else:
-                peer = self.nearest.getNodeById(peerid)
-                self.nearestWithoutValue.push(peer)
-                self.nearest.push(response.getNodeList())
-        self.nearest.remove(toremove)
-
-        if len(foundValues) > 0:
-            return self._handleFoundValues(foundValues)
-        if self.nearest.allBeenContacted():
-            # not found!
-            return None
-        return self.find()
+    def _handleResponse(self, peer, response):
+        """
+        Handle a single answer (or timeout) from a peer.
+        """
+        if not response.happened():
+            self.nearest.remove([peer.id])
+        elif response.hasValue():
+            self._finish(self._handleFoundValues([response.getValue()]))
+        else:
+            self.nearest.markResponded(peer)
+            self.nearestWithoutValue.push(peer)
+            self.nearest.push(response.getNodeList())
+
+    def _notFound(self):
+        return None
 
     def _handleFoundValues(self, values):
         """
@@ -114,10 +228,21 @@ class ValueSpiderCrawl(SpiderCrawl):
 
         peerToSaveTo = self.nearestWithoutValue.popleft()
         if peerToSaveTo is not None:
-            d = self.protocol.callStore(peerToSaveTo, self.node.id, value)
+            d = self.protocol.callStore(peerToSaveTo, self.node.id.hex(), value, self.cacheTTL(peerToSaveTo))
             return d.addCallback(lambda _: value)
         return value
 
+    def cacheTTL(self, peer):
+        """
+        How long peer should keep the copy it's asked to cache.  Per section
+        2.3 of the paper, the time halves for every node we know of that is
+        closer to the key than peer is, so copies far from the key, which
+        would otherwise be cached all over, don't last.
+        """
+        distance = peer.distanceTo(self.node)
+        closer = sum(1 for n in self.nearest if n.distanceTo(self.node) < distance)
+        return self.cacheTime / 2 ** closer
+
 
 class NodeSpiderCrawl(SpiderCrawl):
     def find(self):
@@ -126,22 +251,18 @@ class NodeSpiderCrawl(SpiderCrawl):
         """
         return self._find(self.protocol.callFindNode)
 
-    def _nodesFound(self, responses):
+    def _handleResponse(self, peer, response):
         """
-        Handle the result of an iteration in _find.
+        Handle a single answer (or timeout) from a peer.
         """
-        toremove = []
-        for peerid, response in list(responses.items()):
-            response = RPCFindResponse(response)
-            if not response.happened():
-                toremove.append(peerid)
-            else:
-                self.nearest.push(response.getNodeList())
-        self.nearest.remove(toremove)
+        if not response.happened():
+            self.nearest.remove([peer.id])
+        else:
+            self.nearest.markResponded(peer)
+            self.nearest.push(response.getNodeList())
 
-        if self.nearest.allBeenContacted():
-            return list(self.nearest)
-        return self.find()
+    def _notFound(self):
+        return list(self.nearest)
 
 
 class RPCFindResponse(object):
@@ -151,7 +272,8 @@ class RPCFindResponse(object):
 
         Args:
             response: This will be a tuple of (<response received>, <value>)
-                      where <value> will be a list of tuples if not found or
+                      where <value> will be a list of tuples (or, from
+                      version 3 peers, a packed contact list) if not found or
                       a dictionary of {'value': v} where v is the value desired
         """
         self.response = response
@@ -174,4 +296,9 @@ class RPCFindResponse(object):
         be set.
         """
         nodelist = self.response[1] or []
-        return [Node(*nodeple) for nodeple in nodelist]
+        if isinstance(nodelist, bytes):
+            try:
+                nodelist = unpackContacts(nodelist)
+            except ValueError:
+                return []
+        return [Node.intern(*nodeple) for nodeple in nodelist]
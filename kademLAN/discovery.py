@@ -8,11 +8,15 @@ import socket
 import time
 from pyre.zactor import ZActor
 from pyre.zbeacon import ZBeacon
+from twisted.internet import reactor
+
+from kademLAN.beacon import EXTENSION, EXTENSION_TAG
 
 
 BEACON_VERSION = 1
 ZRE_DISCOVERY_PORT = 5670
-REAP_INTERVAL = 10.0  # Once per second
+REAP_INTERVAL = 10.0  # Seconds between looking for silent peers
+PEER_EXPIRY = 30.0  # Seconds without a beacon before a peer is dropped
 
 logger = logging.getLogger("Discover")
 logger.propagate = False
@@ -20,7 +24,18 @@ logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
 class Discover(object):
-    def __init__(self, port=8080, *args, **kwargs):
+    def __init__(self, port=8080, peerJoined=None, peerLeft=None, nodeID=None, version=1, *args, **kwargs):
+        """
+        peerJoined and peerLeft, if given, are called in the reactor thread
+        with a peer's (ip, port) as soon as its first beacon, or its
+        goodbye beacon, arrives.  peerJoined is also given the peer's node
+        id and protocol version, or None for each if its beacon didn't
+        carry them.  If nodeID is given, our beacons carry it and version.
+        """
+        self.peerJoined = peerJoined
+        self.peerLeft = peerLeft
+        self.nodeID = nodeID
+        self.version = version
         self._ctx = zmq.Context()
         self._terminated = False  # API shut us down
         self._verbose = False  # Log all traffic (logging module?)
@@ -36,6 +51,8 @@ class Discover(object):
         self.port = port  # Our inbox port, if any
         self.status = 0  # Our own change counter
         self.peers = {}  # Hash of known peers, fast lookup
+        self.lastSeen = {}  # When each peer's last beacon arrived
+        self.reaped = time.time()  # When silent peers were last dropped
         self.headers = {}  # Our header values
         # TODO: gossip stuff
         # self.start()
@@ -69,6 +86,8 @@ class Discover(object):
             transmit = struct.pack('cccb16sH', b'Z', b'R', b'E',
                                    BEACON_VERSION, self.identity.bytes,
                                    socket.htons(self.port))
+            if self.nodeID is not None:
+                transmit += EXTENSION.pack(EXTENSION_TAG, self.nodeID, self.version)
             self.beacon.send_unicode("PUBLISH", zmq.SNDMORE)
             self.beacon.send(transmit)
             # construct the header filter  (to discard none zre messages)
@@ -101,16 +120,28 @@ class Discover(object):
         self.beacon_port = 0
 
     # Find or create peer via its UUID string
-    def require_peer(self, identity, endpoint):
+    def require_peer(self, identity, endpoint, nodeID=None, version=None):
         """
 
         :param identity:
         :param endpoint:
+        :param nodeID: node id from the beacon, if it had one
+        :param version: protocol version from the beacon, if it had one
         :return: endpoint of peer
         """
+        self.lastSeen[identity] = time.time()
         p = self.peers.get(identity)
         if not p:
+            # a peer restarted at the same endpoint beacons with a new
+            # UUID; its old one is dropped quietly rather than reaped
+            # later, which would report the endpoint as gone
+            for other, known in list(self.peers.items()):
+                if known == endpoint:
+                    self.peers.pop(other)
+                    self.lastSeen.pop(other, None)
             self.peers[identity] = endpoint
+            if self.peerJoined is not None:
+                reactor.callFromThread(self.peerJoined, endpoint, nodeID, version)
         return p
 
 
@@ -121,7 +152,10 @@ class Discover(object):
     #  Remove a peer from our data structures
     def remove_peer(self, peer):
         # To destroy peer, we remove from peers hash table (dict)
-        self.peers.pop(peer)
+        endpoint = self.peers.pop(peer)
+        self.lastSeen.pop(peer, None)
+        if self.peerLeft is not None:
+            reactor.callFromThread(self.peerLeft, endpoint)
 
     def recv_beacon(self):
         # Get IP address and beacon of peer
@@ -129,7 +163,8 @@ class Discover(object):
         ipaddress = msgs.pop(0)
         frame = msgs.pop(0)
 
-        beacon = struct.unpack('cccb16sH', frame)
+        # kademLAN beacons have the node id appended; see kademLAN.beacon
+        beacon = struct.unpack_from('cccb16sH', frame)
         # Ignore anything that isn't a valid beacon
         if beacon[3] != BEACON_VERSION:
             logger.warning("Invalid ZRE Beacon version: {0}".format(beacon[3]))
@@ -137,9 +172,13 @@ class Discover(object):
 
         peer_id = uuid.UUID(bytes=beacon[4])
         port = socket.ntohs(beacon[5])
+        nodeID = version = None
+        extension = frame[struct.calcsize('cccb16sH'):]
+        if len(extension) >= EXTENSION.size and extension[:1] == EXTENSION_TAG:
+            _, nodeID, version = EXTENSION.unpack_from(extension)
         # if we receive a beacon with port 0 this means the peer exited
         if port:
-            peer = self.require_peer(peer_id, (str(ipaddress.decode('UTF-8')), port))
+            peer = self.require_peer(peer_id, (str(ipaddress.decode('UTF-8')), port), nodeID, version)
         else:
             # Zero port means peer is going away; remove it if
             # we had any knowledge of it already
@@ -153,6 +192,16 @@ class Discover(object):
                 logger.warning(self.peers)
                 logger.warning("We don't know peer id {0}".format(peer_id))
 
+    #  Drop peers we haven't heard a beacon from in PEER_EXPIRY seconds;
+    #  they went away without saying so
+    def reap_peers(self):
+        now = time.time()
+        self.reaped = now
+        for peer, seen in list(self.lastSeen.items()):
+            if seen < now - PEER_EXPIRY:
+                logger.debug("Peer {0} went silent, removing it".format(self.peers[peer]))
+                self.remove_peer(peer)
+
     # TODO: Handle gossip dat
 
     # --------------------------------------------------------------------------
@@ -163,6 +212,8 @@ class Discover(object):
             items = dict(self.poller.poll(1000))
             if self.beacon_socket in items and items[self.beacon_socket] == zmq.POLLIN:
                 self.recv_beacon()
+            if time.time() >= self.reaped + REAP_INTERVAL:
+                self.reap_peers()
 
 
 if __name__ == "__main__":
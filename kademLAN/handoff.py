@@ -0,0 +1,188 @@
+"""
+Background handoff of stored keys to nodes that have just joined.
+"""
+import umsgpack
+from twisted.internet import reactor
+
+from kademLAN.log import Logger
+from kademLAN.node import Node
+
+
+class HandoffJob(object):
+    """
+    The keys still to be handed to one new node.
+    """
+    def __init__(self, node, keys):
+        self.node = node
+        self.keys = keys
+        self.inflight = 0
+        self.exhausted = False
+        self.sent = 0
+
+
+class HandoffScheduler(object):
+    """
+    Hands a newly seen node the keys it should be storing, per section 2.5 of
+    the paper, without walking all of storage at once or flooding the node.
+
+    The candidate keys are found with a range query on the storage key
+    index, and are sent a batch at a time with L{KademliaProtocol.callStoreMany},
+    with at most concurrency batches in flight and at most rate bytes of
+    values sent per second across all new nodes.
+    """
+    def __init__(self, protocol, ksize, rate=262144, concurrency=2, batchSize=100,
+                 cooldown=600, clock=None):
+        """
+        Args:
+            protocol: A :class:`~kademLAN.protocol.KademliaProtocol` instance.
+            ksize: The value for k based on the paper
+            rate: Bytes of keys and values to send per second.
+            concurrency: The most batches in flight at once.
+            batchSize: The most keys in one batch.
+            cooldown: Seconds during which a node that was handed its keys
+                      isn't handed them again if it's seen as new again.
+        """
+        self.protocol = protocol
+        self.ksize = ksize
+        self.rate = rate
+        self.concurrency = concurrency
+        self.batchSize = batchSize
+        self.cooldown = cooldown
+        self.clock = clock or reactor
+        self.jobs = []
+        self.pending = {}
+        self.recent = {}
+        self.inflight = 0
+        self.tokens = rate
+        self.refilled = self.clock.seconds()
+        self.wakeup = None
+        self.log = Logger(system=self)
+
+    def schedule(self, node):
+        """
+        Queue a handoff to node, unless one is already queued or node was
+        handed its keys within the cooldown.
+
+        Returns True if a handoff was queued.
+        """
+        now = self.clock.seconds()
+        if node.id in self.pending or self.recent.get(node.id, -self.cooldown) > now - self.cooldown:
+            return False
+        job = HandoffJob(node, self.keysFor(node))
+        self.pending[node.id] = job
+        self.jobs.append(job)
+        self.pump()
+        return True
+
+    def keysFor(self, node):
+        """
+        Yield the stored (key, value) pairs node should have and that this
+        node is the one to send.
+
+        Only keys in the smallest id range around node that can hold keys it
+        is among the k closest nodes to are looked at, so the cost is in the
+        number of keys near node rather than all stored keys.
+        """
+        neighbors = self.protocol.router.findNeighbors(node, exclude=node)
+        if len(neighbors) < self.ksize:
+            span = 2 ** 160
+        else:
+            span = 2 ** neighbors[-1].distanceTo(node).bit_length()
+        lower = node.long_id - node.long_id % span
+
+        for key in self.protocol.storage.iterkeysInRange(lower, lower + span - 1):
+            value = self.protocol.storage.get(key, None)
+            if value is not None and self.shouldSend(node, Node(key)):
+                yield key, value
+
+    def shouldSend(self, node, keynode):
+        """
+        Send a key to node if node is among the k closest nodes we know of
+        for it, and we are closer to it than any of the others.
+        """
+        neighbors = self.protocol.router.findNeighbors(keynode)
+        others = [n for n in neighbors if n.id != node.id]
+        newNodeClose = len(neighbors) < self.ksize or node.distanceTo(keynode) <= neighbors[-1].distanceTo(keynode)
+        thisNodeClosest = len(others) == 0 or self.protocol.sourceNode.distanceTo(keynode) < others[0].distanceTo(keynode)
+        return newNodeClose and thisNodeClosest
+
+    def pump(self):
+        """
+        Send batches while there's room under the concurrency and bandwidth
+        budgets.
+        """
+        while self.inflight < self.concurrency and len(self.jobs) > 0:
+            if not self.refill():
+                return
+            job = self.jobs.pop(0)
+            batch = self.nextBatch(job)
+            if len(batch) > 0:
+                self.send(job, batch)
+            if not job.exhausted:
+                # round robin between new nodes
+                self.jobs.append(job)
+            elif job.inflight == 0:
+                self.finish(job)
+
+    def refill(self):
+        """
+        Top up the bandwidth budget.  If it's spent, arrange to pump again
+        once it's back in credit and return False.
+        """
+        now = self.clock.seconds()
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens > 0:
+            return True
+        if self.wakeup is None:
+            self.wakeup = self.clock.callLater(-self.tokens / float(self.rate), self.wake)
+        return False
+
+    def wake(self):
+        self.wakeup = None
+        self.pump()
+
+    def nextBatch(self, job):
+        batch = {}
+        for key, value in job.keys:
+            batch[key] = value
+            if len(batch) >= self.batchSize:
+                return batch
+        job.exhausted = True
+        return batch
+
+    def send(self, job, batch):
+        self.tokens -= len(umsgpack.packb(list(batch.items())))
+        self.inflight += 1
+        job.inflight += 1
+        job.sent += len(batch)
+
+        def sent(stored):
+            self.inflight -= 1
+            job.inflight -= 1
+            if len(stored) > 0 and not any(stored.values()):
+                self.log.debug("handoff to %s failed, dropping it" % job.node)
+                job.exhausted = True
+                if job in self.jobs:
+                    self.jobs.remove(job)
+            if job.exhausted and job.inflight == 0:
+                self.finish(job)
+            self.pump()
+
+        def failed(failure):
+            self.log.warning("handoff batch to %s failed: %s" % (job.node, failure.getErrorMessage()))
+            return dict((key, False) for key in batch)
+
+        times = dict((key, self.protocol.storage.timesFor(key)) for key in batch)
+        d = self.protocol.callStoreMany(job.node, batch, times=times)
+        return d.addErrback(failed).addCallback(sent)
+
+    def finish(self, job):
+        if self.pending.pop(job.node.id, None) is None:
+            return
+        self.log.info("handed %i keys to %s" % (job.sent, job.node))
+        now = self.clock.seconds()
+        for nodeid, finished in list(self.recent.items()):
+            if finished <= now - self.cooldown:
+                del self.recent[nodeid]
+        self.recent[job.node.id] = now
@@ -6,15 +6,16 @@ import pickle
 
 from twisted.internet.task import LoopingCall
 from twisted.internet import defer, reactor, task
-from kademLAN.discovery import Discover
 
 from kademLAN.log import Logger
-from kademLAN.protocol import KademliaProtocol
-from kademLAN.utils import deferredDict, digest
-from kademLAN.storage import ForgetfulStorage
+from kademLAN.protocol import KademliaProtocol, PROTOCOL_VERSION
+from kademLAN.utils import deferredDict, digest, SingleFlight
+from kademLAN.storage import ForgetfulStorage, keyID
+from kademLAN.bootstrap import BootstrapScheduler
 from kademLAN.node import Node
 from kademLAN.crawling import ValueSpiderCrawl
 from kademLAN.crawling import NodeSpiderCrawl
+from kademLAN.crawling import HedgePolicy
 
 
 class Server(object):
@@ -23,7 +24,8 @@ class Server(object):
     to start listening as an active node on the network.
     """
 
-    def __init__(self, port, ksize=20, alpha=3, id=None, storage=None):
+    def __init__(self, port, ksize=20, alpha=3, id=None, storage=None, hedgePercentile=95, hedgeBudget=2,
+                 discovery=None, announceID=False):
         """
         Create a server instance.  This will start listening on the given port.
 
@@ -32,20 +34,45 @@ class Server(object):
             alpha (int): The alpha parameter from the paper
             id: The id for this node on the network.
             storage: An instance that implements :interface:`~kademLAN.storage.IStorage`
+            hedgePercentile: In a get, a find_value call outstanding for longer than this
+                             percentile of observed RPC round trip times is hedged.
+            hedgeBudget (int): The most hedged calls a single get may send; 0 disables hedging.
+                               How often hedges fired and won is kept in `self.hedging`.
+            discovery: The class used to find peers on the LAN, called with our port and the
+                       peerJoined and peerLeft callbacks, and our node id and protocol
+                       version to announce (or None).  Defaults to the zmq based
+                       :class:`~kademLAN.discovery.Discover`; :class:`~kademLAN.beacon.BeaconDiscover`
+                       does the same on the reactor, without zmq or a thread.
+            announceID (bool): Add our node id to our discovery beacons, so peers can put us
+                               in their routing tables without pinging us.  Discovery before
+                               this option existed can't parse such beacons and stops altogether
+                               on one, so only turn it on once every node on the LAN is upgraded.
         """
         self.bootstrapped = False
         self.bootstrap_cb = ()
-        self.discovered_peers = []
+        self.discovered_peers = set()
         self.port = port
-        self.discover = Discover(self.port)
         self.ksize = ksize
         self.alpha = alpha
+        self.hedging = HedgePolicy(hedgePercentile, hedgeBudget)
+        # lookups in flight by key digest, shared by concurrent callers;
+        # each keeps a count of how many callers it saved a lookup
+        self.inflightGets = SingleFlight()
+        self.inflightSets = SingleFlight()
         self.log = Logger(system=self)
         self.storage = storage or ForgetfulStorage()
         self.node = Node(id or digest(random.getrandbits(255)))
         self.protocol = KademliaProtocol(self.node, self.storage, ksize)
+        if getattr(self.storage, 'responsible', False) is None:
+            self.storage.responsible = self.isResponsibleFor
+        self.bootstrapper = BootstrapScheduler(self.protocol, ksize, alpha, self.post_bootstrap)
+        if discovery is None:
+            # imported here so that zmq is only needed when it's used
+            from kademLAN.discovery import Discover as discovery
+        self.discover = discovery(self.port, self.peerJoined, self.peerLeft,
+                                  nodeID=self.node.id if announceID else None,
+                                  version=PROTOCOL_VERSION)
         #self.refreshLoop = LoopingCall(self.refreshTable).start(3600)
-        self.get_peers_loop = LoopingCall(self.get_peers).start(5)
     def listen(self, cb, *args):
         """
         Start listening on the given port.
@@ -56,44 +83,74 @@ class Server(object):
         """
         self.bootstrap_cb = (cb, args)
         self.discover.start()
+        self.storage.start()
+        self.protocol.antiEntropy.start()
         return reactor.listenUDP(self.port, self.protocol)
 
-    def get_peers(self):
-        peers = self.discover.get_peers()
-        peercopy = []
-        for p in peers:
-            if p not in self.discovered_peers:
-                peercopy.append(p)
-        if len(peercopy) != 0:
-            self.log.debug("Found peers:{}".format(peercopy))
-            self.bootstrap(peercopy).addCallback(self.post_bootstrap)
-            self.discovered_peers.extend(peercopy)
+    def peerJoined(self, addr, nodeID=None, version=None):
+        """
+        Called by discovery, in the reactor thread, when a peer's beacon is
+        first heard.  The peer is handed to `self.bootstrapper`, which
+        batches peers and looks up our own id from them.
+
+        If the beacon carried the peer's node id, the peer goes straight
+        into the routing table, and needn't be pinged to learn it.
+
+        Discovery reports each peer once, so a join from an address we
+        already have is a peer that restarted there, and what we knew of
+        its last run is dropped first.
+        """
+        if addr in self.discovered_peers:
+            self.peerLeft(addr)
+        self.discovered_peers.add(addr)
+        self.log.debug("Found peer:{}".format(addr))
+        if nodeID is None:
+            self.bootstrapper.add(addr)
+            return
+        if version is not None:
+            self.protocol.learnVersion(addr, version)
+        self.bootstrapper.add(Node.intern(nodeID, addr[0], addr[1]))
+
+    def peerLeft(self, addr):
+        """
+        Called by discovery, in the reactor thread, when a peer says it's
+        going away or has gone silent.  It's dropped from the routing table
+        straight away, rather than after lookups have timed out on it.
+        """
+        self.discovered_peers.discard(addr)
+        self.bootstrapper.discard(addr)
+        self.protocol.forgetPeer(addr)
 
     def post_bootstrap(self, found):
         if not self.bootstrapped:
             self.bootstrap_cb[0](*self.bootstrap_cb[1])
             self.bootstrapped = True
 
+    def isResponsibleFor(self, dkey):
+        """
+        Whether this node is one of the k closest nodes it knows of to the
+        key digest dkey.
+        """
+        if keyID(dkey) is None:
+            return False
+        node = Node(dkey)
+        neighbors = self.protocol.router.index.nearest(node.long_id, self.ksize)
+        return len(neighbors) < self.ksize or self.node.distanceTo(node) < neighbors[-1].distanceTo(node)
+
     def refreshTable(self):
         """
         Refresh buckets that haven't had any lookups in the last hour
-        (per section 2.3 of the paper).
+        (per section 2.3 of the paper).  Keys aren't republished here: the
+        protocol's :class:`~kademLAN.antientropy.AntiEntropy` keeps replicas
+        in step instead.
         """
         ds = []
         for id in self.protocol.getRefreshIDs():
-            node = Node(id)
+            node = Node(id.to_bytes(20, 'big'))
             nearest = self.protocol.router.findNeighbors(node, self.alpha)
-            spider = NodeSpiderCrawl(self.protocol, node, nearest)
+            spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
             ds.append(spider.find())
-
-        def republishKeys(_):
-            ds = []
-            # Republish keys older than one hour
-            for key, value in self.storage.iteritemsOlderThan(3600):
-                ds.append(self.set(key, value))
-            return defer.gatherResults(ds)
-
-        return defer.gatherResults(ds).addCallback(republishKeys)
+        return defer.gatherResults(ds)
 
     def bootstrappableNeighbors(self):
         """
@@ -108,31 +165,34 @@ class Server(object):
         neighbors = self.protocol.router.findNeighbors(self.node)
         return [ tuple(n)[-2:] for n in neighbors ]
 
-    def bootstrap(self, addrs):
+    def bootstrap(self, addrs, nodes=()):
         """
         Bootstrap the server by connecting to other known nodes in the network.
 
         Args:
             addrs: A `list` of (ip, port) `tuple` pairs.  Note that only IP addresses
                    are acceptable - hostnames will cause an error.
+            nodes: :class:`~kademLAN.node.Node` instances whose ids are already known,
+                   which are looked up from without being pinged first.
         """
         # if the transport hasn't been initialized yet, wait a second
         if self.protocol.transport is None:
             self.log.debug("Transport not init")
-            return task.deferLater(reactor, 1, self.bootstrap, addrs)
+            return task.deferLater(reactor, 1, self.bootstrap, addrs, nodes)
 
         def initTable(results):
-            nodes = []
+            nodes = list(known)
             for addr, result in list(results.items()):
                 if result[0]:
-                    nodes.append(Node(result[1], addr[0], addr[1]))
+                    nodes.append(Node.intern(result[1], addr[0], addr[1]))
             spider = NodeSpiderCrawl(self.protocol, self.node, nodes, self.ksize, self.alpha)
             return spider.find()
 
+        known = nodes
         ds = {}
         for addr in addrs:
             self.log.debug("Pinging Peers:{}".format(addr))
-            ds[addr] = self.protocol.ping(addr, self.node.id)
+            ds[addr] = self.protocol.ping(addr, self.node.id.hex())
         self.log.debug("Pinged All peers:{}".format(addrs))
         return deferredDict(ds).addCallback(initTable)
 
@@ -155,38 +215,221 @@ class Server(object):
 
     def get(self, key):
         """
-        Get a key if the network has it.
+        Get a key if the network has it.  If this node is storing the key
+        itself, it is returned without going to the network, and concurrent
+        gets for the same key share a single lookup.
 
         Returns:
             :class:`None` if not found, the value otherwise.
         """
-        node = Node(digest(key))
+        dkey = digest(key)
+        value = self.storage.get(dkey)
+        if value is not None:
+            return defer.succeed(value)
+        return self.inflightGets.call(dkey, self._findValue, key, Node(dkey))
+
+    def _findValue(self, key, node):
         nearest = self.protocol.router.findNeighbors(node)
         if len(nearest) == 0:
             self.log.warning("There are no known neighbors to get key %s" % key)
             return defer.succeed(None)
-        spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
+        spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha, self.hedging)
         return spider.find()
 
     def set(self, key, value):
         """
-        Set the given key to the given value in the network.
+        Set the given key to the given value in the network.  If this node is
+        one of the k closest to the key, it keeps a copy itself in place of
+        the farthest remote node.  Concurrent sets for the same key share
+        the lookup of the nodes to store it on.
         """
         self.log.debug("setting '%s' = '%s' on network" % (key, value))
         dkey = digest(key)
+        node = Node(dkey)
 
         def store(nodes):
+            nodes = self._replicasFor(node, nodes)
+            local = False
+            if self.node in nodes:
+                local = self.storage.set(dkey, value)
+                nodes.remove(self.node)
             self.log.info("setting '%s' on %s" % (key, list(map(str, nodes))))
-            ds = [self.protocol.callStore(node, dkey, value) for node in nodes]
-            return defer.DeferredList(ds).addCallback(self._anyRespondSuccess)
+            ds = [self.protocol.callStore(n, dkey, value) for n in nodes]
+            d = defer.DeferredList(ds).addCallback(self._anyRespondSuccess)
+            return d.addCallback(lambda stored: stored or local)
 
-        node = Node(dkey)
+        return self.inflightSets.call(dkey, self._findNodes, key, node).addCallback(store)
+
+    def _findNodes(self, key, node):
         nearest = self.protocol.router.findNeighbors(node)
         if len(nearest) == 0:
-            self.log.warning("There are no known neighbors to set key %s" % key)
-            return defer.succeed(False)
+            self.log.warning("There are no known neighbors for key %s, only this node will have it" % key)
+            return defer.succeed([])
         spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
-        return spider.find().addCallback(store)
+        return spider.find()
+
+    def get_many(self, keys):
+        """
+        Get many keys at once.  Keys that live in the same part of the network
+        share one node lookup, and each peer there is asked for all of the
+        keys it might have in one go.  Keys whose neighborhood couldn't all be
+        asked, because a request failed, fall back to a regular :meth:`get`.
+
+        Returns:
+            A `dict` of each key to its value (or :class:`None` if not found).
+        """
+        results = {}
+        wanted = {}
+        for key in keys:
+            dkey = digest(key)
+            value = self.storage.get(dkey)
+            if value is not None:
+                results[key] = value
+            else:
+                wanted[dkey] = key
+
+        def found(result):
+            values, unasked = result
+            missing = {}
+            for dkey, key in wanted.items():
+                if dkey in values:
+                    results[key] = values[dkey]
+                elif dkey in unasked:
+                    missing[key] = self.get(key)
+                else:
+                    results[key] = None
+
+            def merge(rest):
+                results.update(rest)
+                return results
+            return deferredDict(missing).addCallback(merge)
+
+        d = self._findNeighborhoods(list(wanted))
+        return d.addCallback(self._findValuesIn).addCallback(found)
+
+    def set_many(self, mapping):
+        """
+        Set many keys at once.  Keys that live in the same part of the network
+        share one node lookup, and each peer there is sent all of the keys it
+        should store in one go.  As with :meth:`set`, this node keeps the
+        keys it is one of the k closest nodes for.
+
+        Returns:
+            A `dict` of each key to whether it was stored anywhere.
+        """
+        items = dict((digest(key), (key, value)) for key, value in mapping.items())
+
+        def store(neighborhoods):
+            stored = set()
+            batches = {}
+            for dkeys, nodes in neighborhoods:
+                for dkey in dkeys:
+                    value = items[dkey][1]
+                    for node in self._replicasFor(Node(dkey), nodes):
+                        if node is self.node:
+                            if self.storage.set(dkey, value):
+                                stored.add(dkey)
+                        else:
+                            batches.setdefault(node, {})[dkey] = value
+
+            def collect(responses):
+                for success, result in responses:
+                    if success:
+                        stored.update(dkey for dkey, ok in result.items() if ok)
+                return dict((key, dkey in stored) for dkey, (key, _) in items.items())
+
+            ds = [self.protocol.callStoreMany(node, batch) for node, batch in batches.items()]
+            return defer.DeferredList(ds, consumeErrors=True).addCallback(collect)
+
+        return self._findNeighborhoods(list(items)).addCallback(store)
+
+    def _findNeighborhoods(self, dkeys):
+        """
+        Group key digests by the part of the network that stores them, and
+        look up the closest nodes once per group.
+
+        Groups are built over the digests in id order.  A group's first key
+        leads it, and the smallest subtree of the id space that holds the
+        lead's k closest known contacts is its neighborhood.  If that subtree
+        holds no other contacts, every following key in it joins the group,
+        since the same contacts are also the closest ones to it.  Otherwise a
+        following key joins only if its own k closest contacts are the lead's.
+
+        Returns:
+            A `list` of (digests, nodes) pairs, one per group, where nodes are
+            the closest nodes found to the group's lead.
+        """
+        groups = []
+        for dkey in sorted(dkeys):
+            node = Node(dkey)
+            if len(groups) > 0 and groups[-1][0].distanceTo(node) < groups[-1][1]:
+                groups[-1][3].append(dkey)
+                continue
+            nearest = self.protocol.router.findNeighbors(node, self.ksize + 1)
+            closest = set(n.id for n in nearest[:self.ksize])
+            if len(groups) > 0 and groups[-1][2] == closest:
+                groups[-1][3].append(dkey)
+                continue
+            span = 2 ** 160
+            if len(nearest) > self.ksize:
+                span = 2 ** nearest[self.ksize - 1].distanceTo(node).bit_length()
+                if nearest[self.ksize].distanceTo(node) < span:
+                    # keys in there may be closer to the extra contact
+                    span = 0
+            groups.append((node, span, closest, [dkey]))
+
+        ds = []
+        for lead, _, _, members in groups:
+            d = self.inflightSets.call(members[0], self._findNodes, members[0], lead)
+            ds.append(d.addCallback(lambda nodes, members=members: (members, nodes)))
+        return defer.gatherResults(ds)
+
+    def _findValuesIn(self, neighborhoods):
+        """
+        Ask the nodes of each neighborhood for its keys, a few of the closest
+        nodes per key at a time, with every request to a peer batched.
+
+        Returns:
+            A `dict` of each digest found to its value, and a `set` of the
+            digests that weren't found but that some node failed to answer for.
+        """
+        values = {}
+        unasked = set()
+        candidates = {}
+        for dkeys, nodes in neighborhoods:
+            for dkey in dkeys:
+                candidates[dkey] = sorted(nodes, key=Node(dkey).distanceTo)
+
+        def ask(_):
+            batches = {}
+            for dkey, nodes in candidates.items():
+                if dkey not in values:
+                    for node in nodes[:self.alpha]:
+                        batches.setdefault(node, []).append(dkey)
+                    del nodes[:self.alpha]
+            if len(batches) == 0:
+                return values, unasked.difference(values)
+            ds = []
+            for node, batch in batches.items():
+                d = self.protocol.callFindValues(node, batch)
+                d.addCallback(values.update)
+                d.addErrback(self._unanswered, node, batch, unasked)
+                ds.append(d)
+            return defer.DeferredList(ds, consumeErrors=True).addCallback(ask)
+
+        return ask(None)
+
+    def _unanswered(self, failure, node, dkeys, unasked):
+        self.log.warning("finding values on %s failed: %s" % (node, failure.getErrorMessage()))
+        unasked.update(dkeys)
+
+    def _replicasFor(self, node, nearest):
+        """
+        Get the k nodes closest to node out of the given nodes and this one.
+        """
+        nodes = [n for n in nearest if n.id != self.node.id] + [self.node]
+        nodes.sort(key=node.distanceTo)
+        return nodes[:self.ksize]
 
     def _anyRespondSuccess(self, responses):
         """
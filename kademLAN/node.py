@@ -1,13 +1,45 @@
-from operator import itemgetter
-import heapq
+from bisect import bisect_left, insort
+from weakref import WeakValueDictionary
 
 
-class Node:
+class Node(object):
+    """
+    A contact on the network.  The id is kept as raw bytes, and its integer
+    form is computed once up front for distance calculations.
+    """
+    __slots__ = ('id', 'ip', 'port', 'long_id', '__weakref__')
+
+    # canonical instances handed out by Node.intern, keyed by
+    # (id, ip, port) with the id both as given and as raw bytes
+    _interned = WeakValueDictionary()
+
     def __init__(self, id_, ip=None, port=None):
+        """
+        @param id_: The node id as bytes.  A hex string (as used on the
+        wire and returned by L{kademLAN.utils.digest}) is also accepted.
+        """
+        if isinstance(id_, str):
+            id_ = bytes.fromhex(id_)
         self.id = id_
         self.ip = ip
         self.port = port
-        self.long_id = int(id_, 16)
+        self.long_id = int.from_bytes(id_, 'big')
+
+    @classmethod
+    def intern(cls, id_, ip=None, port=None):
+        """
+        Get the canonical C{Node} for the given peer, creating it only if
+        no live instance exists yet.  Peers seen again (on every packet they
+        send us, or in every find response that mentions them) then cost a
+        dict lookup rather than a new object and another id parse.
+        """
+        key = (id_, ip, port)
+        node = cls._interned.get(key)
+        if node is None:
+            node = cls(id_, ip, port)
+            node = cls._interned.setdefault((node.id, ip, port), node)
+            cls._interned[key] = node
+        return node
 
     def sameHomeAs(self, node):
         return self.ip == node.ip and self.port == node.port
@@ -34,62 +66,92 @@ class Node:
         return self.long_id < other.long_id
 
 
+# states of a candidate in a NodeHeap
+UNCONTACTED = 0
+CONTACTED = 1
+RESPONDED = 2
+FAILED = 3
+
+
 class NodeHeap(object):
     """
-    A heap of nodes ordered by distance to a given node.
+    The candidates of a lookup, ordered by distance to a given node.
+
+    Candidates are keyed by id, so a peer returned by several responders is
+    only held once, and each one carries its state in the lookup
+    (uncontacted, contacted, responded or failed).  Only the closest
+    maxsize candidates are visible; a margin of farther ones is kept to take
+    the place of visible ones that fail, and anything beyond that is
+    dropped.
     """
-    def __init__(self, node, maxsize):
+    def __init__(self, node, maxsize, margin=3):
         """
         Constructor.
 
-        @param node: The node to measure all distnaces from.
+        @param node: The node to measure all distances from.
         @param maxsize: The maximum size that this heap can grow to.
+        @param margin: How many candidates past maxsize to hold on to, to
+        stand in for visible ones that fail.  A lookup passes its alpha.
         """
         self.node = node
-        self.heap = []
-        self.contacted = set()
         self.maxsize = maxsize
+        self.capacity = maxsize + margin
+        # sorted (distance, id) pairs, plus the node and state for each id
+        self.heap = []
+        self.nodes = {}
+        self.states = {}
 
     def remove(self, peerIDs):
         """
-        Remove a list of peer ids from this heap.  Note that while this
-        heap retains a constant visible size (based on the iterator), it's
-        actual size may be quite a bit larger than what's exposed.  Therefore,
-        removal of nodes may not change the visible size as previously added
-        nodes suddenly become visible.
-        """
-        peerIDs = set(peerIDs)
-        if len(peerIDs) == 0:
-            return
-        nheap = []
-        for distance, node in self.heap:
-            if node.id not in peerIDs:
-                heapq.heappush(nheap, (distance, node))
-        self.heap = nheap
+        Mark a list of peer ids as failed and remove them from this heap.
+        Failed peers are remembered, so they aren't added back when other
+        peers return them.  Note that while this heap retains a constant
+        visible size (based on the iterator), it's actual size may be a bit
+        larger than what's exposed.  Therefore, removal of nodes may not
+        change the visible size as previously added nodes suddenly become
+        visible.
+        """
+        for peerID in peerIDs:
+            node = self.nodes.pop(peerID, None)
+            if node is not None:
+                del self.heap[bisect_left(self.heap, (self.node.distanceTo(node), peerID))]
+            self.states[peerID] = FAILED
 
     def getNodeById(self, id):
-        for _, node in self.heap:
-            if node.id == id:
-                return node
-        return None
+        return self.nodes.get(id, None)
+
+    def getState(self, node):
+        return self.states.get(node.id, None)
 
     def allBeenContacted(self):
         return len(self.getUncontacted()) == 0
 
+    def allResponded(self):
+        """
+        Have all of the visible nodes answered?
+        """
+        return all(self.states[peerID] == RESPONDED for _, peerID in self.heap[:self.maxsize])
+
     def getIDs(self):
-        return [n.id for n in self]
+        return [peerID for _, peerID in self.heap[:self.maxsize]]
 
     def markContacted(self, node):
-        self.contacted.add(node.id)
+        self.states[node.id] = CONTACTED
+
+    def markResponded(self, node):
+        self.states[node.id] = RESPONDED
 
     def popleft(self):
         if len(self) > 0:
-            return heapq.heappop(self.heap)[1]
+            _, peerID = self.heap.pop(0)
+            return self.nodes.pop(peerID)
         return None
 
     def push(self, nodes):
         """
-        Push nodes onto heap.
+        Push nodes onto heap.  Nodes already known (including those that
+        have failed) are ignored, as are nodes farther than everything held
+        once the heap is at capacity.
 
         @param nodes: This can be a single item or a C{list}.
         """
@@ -97,15 +159,28 @@ class NodeHeap(object):
             nodes = [nodes]
 
         for node in nodes:
-            distance = self.node.distanceTo(node)
-            heapq.heappush(self.heap, (distance, node))
+            if node.id in self.states:
+                continue
+            item = (self.node.distanceTo(node), node.id)
+            if len(self.heap) >= self.capacity and item > self.heap[-1]:
+                continue
+            insort(self.heap, item)
+            self.nodes[node.id] = node
+            self.states[node.id] = UNCONTACTED
+            if len(self.heap) > self.capacity:
+                _, dropped = self.heap.pop()
+                del self.nodes[dropped]
+                # a candidate that was already queried keeps its state, so
+                # it isn't queried again if a later response returns it
+                if self.states[dropped] == UNCONTACTED:
+                    del self.states[dropped]
 
     def __len__(self):
         return min(len(self.heap), self.maxsize)
 
     def __iter__(self):
-        nodes = heapq.nsmallest(self.maxsize, self.heap)
-        return iter(map(itemgetter(1), nodes))
+        return iter([self.nodes[peerID] for _, peerID in self.heap[:self.maxsize]])
 
     def getUncontacted(self):
-        return [n for n in self if n.id not in self.contacted]
+        return [self.nodes[peerID] for _, peerID in self.heap[:self.maxsize]
+                if self.states[peerID] == UNCONTACTED]
@@ -1,21 +1,90 @@
 import random
+import time
 
+import umsgpack
 from twisted.internet import defer
 
+from rpcudp.exceptions import MalformedMessage
 from rpcudp.protocol import RPCProtocol
 
 from kademLAN.node import Node
 from kademLAN.routing import RoutingTable
+from kademLAN.antientropy import AntiEntropy, idToWire, idFromWire
+from kademLAN.handoff import HandoffScheduler
 from kademLAN.log import Logger
-from kademLAN.utils import digest
+from kademLAN.rtt import RTTEstimator
+from kademLAN.utils import SingleFlight
+from kademLAN.wire import packContacts
+
+# Version 1 is the original set of single-key RPCs.  Version 2 adds the
+# version handshake and the batched store_many and find_values RPCs.
+# Version 3 sends ids as raw bytes and contact lists in the compact
+# encoding from kademLAN.wire.  Version 4 lets store and store_many carry
+# how many seconds the stored values should be kept for.  Version 5 adds
+# the merkle_summaries and merkle_entries RPCs used for anti-entropy.
+PROTOCOL_VERSION = 5
+
+# rpcudp refuses to send a request whose packed name and arguments are
+# bigger than this, so batches are split to stay under it.
+MAX_PAYLOAD = 8192
+
+# room left in each request for the rpc name, our id and msgpack framing
+PAYLOAD_BUDGET = MAX_PAYLOAD - 128
+
+
+def packedSize(obj):
+    return len(umsgpack.packb(obj))
+
+
+def validTTL(ttl):
+    """
+    A ttl from a peer, or None if it sent something that isn't one.
+    """
+    if isinstance(ttl, (int, float)) and not isinstance(ttl, bool) and ttl > 0:
+        return ttl
+    return None
+
+
+def validAge(age):
+    """
+    A value's age from a peer, or None if it sent something that isn't one.
+    """
+    if isinstance(age, (int, float)) and not isinstance(age, bool) and age >= 0:
+        return age
+    return None
+
+
+def chunked(items, budget=PAYLOAD_BUDGET):
+    """
+    Split the list items into lists whose packed size stays within budget.
+    An item too big to fit on its own is still yielded, by itself.
+    """
+    chunk, size = [], 0
+    for item in items:
+        itemSize = packedSize(item)
+        if chunk and size + itemSize > budget:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(item)
+        size += itemSize
+    if chunk:
+        yield chunk
 
 
 class KademliaProtocol(RPCProtocol):
-    def __init__(self, sourceNode, storage, ksize):
+    def __init__(self, sourceNode, storage, ksize, rtt=None):
+        """
+        @param rtt: The L{RTTEstimator} used to time out calls to each peer.
+        """
         RPCProtocol.__init__(self)
         self.router = RoutingTable(self, ksize, sourceNode)
         self.storage = storage
         self.sourceNode = sourceNode
+        self.rtt = rtt or RTTEstimator()
+        self.versions = {}
+        self.negotiations = SingleFlight()
+        self.handoff = HandoffScheduler(self, ksize)
+        self.antiEntropy = AntiEntropy(self, ksize)
         self.log = Logger(system=self)
 
     def getRefreshIDs(self):
@@ -31,26 +100,92 @@ class KademliaProtocol(RPCProtocol):
         return sender
 
     def rpc_ping(self, sender, nodeid):
-        source = Node(nodeid, sender[0], sender[1])
+        source = Node.intern(nodeid, sender[0], sender[1])
         self.router.addContact(source)
-        return self.sourceNode.id
+        if self.sentRawID(sender, nodeid):
+            return self.sourceNode.id
+        return self.sourceNode.id.hex()
 
-    def rpc_store(self, sender, nodeid, key, value):
-        source = Node(nodeid, sender[0], sender[1])
+    def rpc_store(self, sender, nodeid, key, value, ttl=None):
+        source = Node.intern(nodeid, sender[0], sender[1])
         self.router.addContact(source)
         self.log.debug("got a store request from %s, storing value" % str(sender))
-        self.storage[key] = value
-        return True
+        return self.storage.set(key, value, validTTL(ttl))
+
+    def rpc_version(self, sender, nodeid, version):
+        source = Node.intern(nodeid, sender[0], sender[1])
+        self.router.addContact(source)
+        self.learnVersion(sender, version)
+        return PROTOCOL_VERSION
+
+    def rpc_store_many(self, sender, nodeid, items):
+        source = Node.intern(nodeid, sender[0], sender[1])
+        self.router.addContact(source)
+        self.learnVersion(sender, 2)
+        self.log.debug("got a store request for %i keys from %s" % (len(items), str(sender)))
+        stored = []
+        for item in items:
+            try:
+                key, value = item[:2]
+                ttl = item[2] if len(item) > 2 else None
+                age = item[3] if len(item) > 3 else None
+                stored.append(self.storage.set(key, value, validTTL(ttl), validAge(age)))
+            except (TypeError, ValueError):
+                stored.append(False)
+        return stored
+
+    def rpc_merkle_summaries(self, sender, nodeid, lower, upper, fanout):
+        source = Node.intern(nodeid, sender[0], sender[1])
+        self.router.addContact(source)
+        self.learnVersion(sender, 5)
+        if not isinstance(fanout, int) or not 2 <= fanout <= 64:
+            return None
+        return self.antiEntropy.summaries(idFromWire(lower), idFromWire(upper), fanout)
+
+    def rpc_merkle_entries(self, sender, nodeid, lower, upper, limit):
+        source = Node.intern(nodeid, sender[0], sender[1])
+        self.router.addContact(source)
+        self.learnVersion(sender, 5)
+        if not isinstance(limit, int):
+            return None
+        entries = self.antiEntropy.entries(idFromWire(lower), idFromWire(upper), min(limit, 256))
+        return [list(entry) for entry in entries]
+
+    def rpc_find_values(self, sender, nodeid, keys):
+        """
+        Return the values we have for keys, and under 'times' how old each
+        is and how long it has left.  Any keys left over once the reply is
+        full are listed under 'more' for the sender to ask again.
+        """
+        source = Node.intern(nodeid, sender[0], sender[1])
+        self.router.addContact(source)
+        self.learnVersion(sender, 2)
+        values, times, size = {}, {}, 0
+        for index, key in enumerate(keys):
+            value = self.storage.get(key, None)
+            if value is None:
+                continue
+            age, ttl = self.storage.timesFor(key)
+            itemSize = packedSize([key, value, age, ttl])
+            if len(values) > 0 and size + itemSize > PAYLOAD_BUDGET:
+                return { 'values': values, 'times': times, 'more': keys[index:] }
+            values[key] = value
+            times[key] = [age, ttl]
+            size += itemSize
+        return { 'values': values, 'times': times, 'more': [] }
 
     def rpc_find_node(self, sender, nodeid, key):
-        self.log.info("finding neighbors of %i in local table" % int(nodeid, 16))
-        source = Node(nodeid, sender[0], sender[1])
+        source = Node.intern(nodeid, sender[0], sender[1])
+        self.log.info("finding neighbors of %i in local table" % source.long_id)
         self.router.addContact(source)
         node = Node(key)
-        return list(map(tuple, self.router.findNeighbors(node, exclude=source)))
+        neighbors = self.router.findNeighbors(node, exclude=source)
+        if self.sentRawID(sender, nodeid):
+            return packContacts(neighbors)
+        return [(n.id.hex(), n.ip, n.port) for n in neighbors]
 
     def rpc_find_value(self, sender, nodeid, key):
-        source = Node(nodeid, sender[0], sender[1])
+        source = Node.intern(nodeid, sender[0], sender[1])
         self.router.addContact(source)
         value = self.storage.get(key, None)
         if value is None:
@@ -58,25 +193,251 @@ class KademliaProtocol(RPCProtocol):
         return { 'value': value }
 
     def callFindNode(self, nodeToAsk, nodeToFind):
-        address = (nodeToAsk.ip, nodeToAsk.port)
-        d = self.find_node(address, self.sourceNode.id, nodeToFind.id)
+        d = self.timedCall('find_node', nodeToAsk, self.wireID(nodeToAsk), self.wireID(nodeToAsk, nodeToFind))
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
     def callFindValue(self, nodeToAsk, nodeToFind):
-        address = (nodeToAsk.ip, nodeToAsk.port)
-        d = self.find_value(address, self.sourceNode.id, nodeToFind.id)
+        d = self.timedCall('find_value', nodeToAsk, self.wireID(nodeToAsk), nodeToFind.id.hex())
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
     def callPing(self, nodeToAsk):
-        address = (nodeToAsk.ip, nodeToAsk.port)
-        d = self.ping(address, self.sourceNode.id)
+        d = self.timedCall('ping', nodeToAsk, self.wireID(nodeToAsk))
+        return d.addCallback(self.handleCallResponse, nodeToAsk)
+
+    def callStore(self, nodeToAsk, key, value, ttl=None):
+        """
+        Store key on nodeToAsk, to be kept for ttl seconds if nodeToAsk is new
+        enough to be told.  Older peers keep it for as long as they like.
+        """
+        args = [self.wireID(nodeToAsk), key, value]
+        if ttl is not None and self.versions.get((nodeToAsk.ip, nodeToAsk.port), 1) >= 4:
+            args.append(ttl)
+        d = self.timedCall('store', nodeToAsk, *args)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
-    def callStore(self, nodeToAsk, key, value):
+    def callVersion(self, nodeToAsk):
+        """
+        Find out which protocol version nodeToAsk speaks, asking it only the
+        first time.  Peers that don't answer are taken to be version 1 peers,
+        which ignore the version RPC, so the answer isn't passed on to
+        handleCallResponse: an old peer shouldn't be dropped from the
+        routing table for it, nor have its timeout backed off.
+        """
         address = (nodeToAsk.ip, nodeToAsk.port)
-        d = self.store(address, self.sourceNode.id, key, value)
+        if address in self.versions:
+            return defer.succeed(self.versions[address])
+
+        def learn(result):
+            version = result[1] if result[0] and isinstance(result[1], int) else 1
+            return self.learnVersion(address, version)
+
+        def ask():
+            d = self.timedCall('version', nodeToAsk, self.sourceNode.id.hex(), PROTOCOL_VERSION,
+                               countTimeout=False)
+            return d.addCallback(learn)
+        return self.negotiations.call(address, ask)
+
+    def learnVersion(self, address, version):
+        """
+        Record that the peer at address speaks at least version, and return
+        the version we now have for it.
+        """
+        self.versions[address] = max(version, self.versions.get(address, 1))
+        return self.versions[address]
+
+    def wireID(self, nodeToAsk, node=None):
+        """
+        The id of node (by default, our own) as it should be sent to
+        nodeToAsk: raw bytes for version 3 peers, hex for older ones.
+        """
+        node = node or self.sourceNode
+        if self.versions.get((nodeToAsk.ip, nodeToAsk.port), 1) >= 3:
+            return node.id
+        return node.id.hex()
+
+    def sentRawID(self, sender, nodeid):
+        """
+        Only version 3 peers send raw ids, so a request that carries one can
+        be answered in the compact encoding.
+        """
+        if isinstance(nodeid, bytes):
+            self.learnVersion(sender, 3)
+            return True
+        return False
+
+    def callStoreMany(self, nodeToAsk, items, ttl=None, times=None):
+        """
+        Store every key/value pair in the C{dict} items on nodeToAsk.  The
+        pairs go in as few store_many requests as fit in a datagram, sent
+        one after another so that a large batch doesn't flood the peer.
+        Peers older than version 2 get one store per key instead.  As with
+        L{callStore}, ttl is only passed on to version 4 peers.
+
+        Copies of values stored here are passed with times, a C{dict} of
+        key to (age, ttl) as the storage's timesFor gives them, so that they
+        keep their age and expiry on nodeToAsk rather than starting anew.
+        Version 4 peers are only told the ttl.
+
+        Returns a deferred C{dict} of each key to whether it was stored.
+        """
+        stored = {}
+
+        def storeNext(result, chunk, chunks):
+            if chunk is not None:
+                ok = result[1] if result[0] and isinstance(result[1], list) else []
+                for index, item in enumerate(chunk):
+                    stored[item[0]] = index < len(ok) and ok[index] is True
+            if len(chunks) == 0:
+                return stored
+            d = self.callBatch('store_many', nodeToAsk, chunks[0])
+            return d.addCallback(storeNext, chunks[0], chunks[1:])
+
+        def send(version):
+            if version < 2:
+                return self.storeEach(nodeToAsk, items, ttl)
+            pairs = []
+            for k, v in items.items():
+                age, left = (times or {}).get(k) or (None, ttl)
+                if age is not None and version >= 5:
+                    pairs.append([k, v, left, age])
+                elif left is not None and version >= 4:
+                    pairs.append([k, v, left])
+                else:
+                    pairs.append([k, v])
+            return storeNext(None, None, list(chunked(pairs)))
+        return self.callVersion(nodeToAsk).addCallback(send)
+
+    def callFindValues(self, nodeToAsk, keys, times=None):
+        """
+        Ask nodeToAsk for the values of all of the given keys, in as few
+        find_values requests as fit in a datagram, sent one after another.
+        Keys the peer had no room for in a reply are asked for again.
+        Peers older than version 2 get one find_value per key instead.
+
+        If times is given, it's filled in with each found key's (age, ttl)
+        where the peer says what they are.
+
+        Returns a deferred C{dict} of each key nodeToAsk had to its value.
+        """
+        values = {}
+
+        def findNext(result, pending):
+            if result is not None and result[0] and isinstance(result[1], dict):
+                found = result[1].get('values', {})
+                values.update(found)
+                if times is not None:
+                    self.readTimes(result[1].get('times'), found, times)
+                # only go back for more if this reply made progress
+                if len(found) > 0:
+                    pending = list(result[1].get('more', [])) + pending
+            if len(pending) == 0:
+                return values
+            chunk = next(chunked(pending))
+            d = self.callBatch('find_values', nodeToAsk, chunk)
+            return d.addCallback(findNext, pending[len(chunk):])
+
+        def send(version):
+            if version < 2:
+                return self.findEach(nodeToAsk, keys)
+            return findNext(None, list(keys))
+        return self.callVersion(nodeToAsk).addCallback(send)
+
+    def readTimes(self, reply, found, times):
+        """
+        Copy the (age, ttl) pairs a find_values reply gives for the keys in
+        found into times, skipping any that aren't valid.
+        """
+        if not isinstance(reply, dict):
+            return
+        for key in found:
+            pair = reply.get(key)
+            if isinstance(pair, list) and len(pair) == 2:
+                age, ttl = validAge(pair[0]), validTTL(pair[1])
+                if age is not None and ttl is not None:
+                    times[key] = (age, ttl)
+
+    def callMerkleSummaries(self, nodeToAsk, lower, upper, fanout):
+        args = (self.wireID(nodeToAsk), idToWire(lower), idToWire(upper), fanout)
+        d = self.timedCall('merkle_summaries', nodeToAsk, *args)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
+    def callMerkleEntries(self, nodeToAsk, lower, upper, limit):
+        args = (self.wireID(nodeToAsk), idToWire(lower), idToWire(upper), limit)
+        d = self.timedCall('merkle_entries', nodeToAsk, *args)
+        return d.addCallback(self.handleCallResponse, nodeToAsk)
+
+    def callBatch(self, name, nodeToAsk, chunk):
+        """
+        Send one chunk of a batched call.  A chunk that is too big to send
+        at all (a single oversized value) comes back as a failed call.
+        """
+        def unsent(failure):
+            failure.trap(MalformedMessage)
+            self.log.warning("batch too big to send to %s" % nodeToAsk)
+            return (False, None)
+        d = defer.maybeDeferred(self.timedCall, name, nodeToAsk, self.wireID(nodeToAsk), chunk)
+        return d.addCallbacks(self.handleCallResponse, unsent, callbackArgs=(nodeToAsk,))
+
+    def storeEach(self, nodeToAsk, items, ttl=None):
+        """
+        Store the C{dict} items on a version 1 peer, one key at a time.  A
+        value too big to send counts as not stored.
+        """
+        stored = {}
+
+        def unsent(failure, key):
+            failure.trap(MalformedMessage)
+            self.log.warning("value for %s too big to send to %s" % (key, nodeToAsk))
+            return (False, None)
+
+        def storeNext(result, key, keys):
+            if key is not None:
+                stored[key] = bool(result[0] and result[1])
+            if len(keys) == 0:
+                return stored
+            d = defer.maybeDeferred(self.callStore, nodeToAsk, keys[0], items[keys[0]], ttl)
+            return d.addErrback(unsent, keys[0]).addCallback(storeNext, keys[0], keys[1:])
+        return storeNext(None, None, list(items))
+
+    def findEach(self, nodeToAsk, keys):
+        """
+        Find the values of keys on a version 1 peer, one key at a time.
+        """
+        values = {}
+
+        def findNext(result, key, keys):
+            if key is not None and result[0] and isinstance(result[1], dict):
+                values[key] = result[1]['value']
+            if len(keys) == 0:
+                return values
+            d = self.callFindValue(nodeToAsk, Node(keys[0]))
+            return d.addCallback(findNext, keys[0], keys[1:])
+        return findNext(None, None, list(keys))
+
+    def timedCall(self, name, nodeToAsk, *args, countTimeout=True):
+        """
+        Call the remote function name on nodeToAsk, timing out after what
+        self.rtt expects for that peer rather than a fixed wait.  The time
+        the call takes (or the fact that it timed out) is fed back into the
+        estimate.  Calls the peer may rightly ignore pass countTimeout=False,
+        so that their timeouts aren't.
+        """
+        address = (nodeToAsk.ip, nodeToAsk.port)
+        default = self._waitTimeout
+        self._waitTimeout = self.rtt.timeoutFor(address)
+        try:
+            d = getattr(self, name)(address, *args)
+        finally:
+            self._waitTimeout = default
+        return d.addCallback(self._timedResponse, address, time.monotonic(), countTimeout)
+
+    def _timedResponse(self, result, address, start, countTimeout=True):
+        if result[0]:
+            self.rtt.update(address, time.monotonic() - start)
+        elif countTimeout:
+            self.rtt.timedOut(address)
+        return result
+
     def transferKeyValues(self, node):
         """
         Given a new node, send it all the keys/values it should be storing.
@@ -84,22 +445,30 @@ class KademliaProtocol(RPCProtocol):
         @param node: A new node that just joined (or that we just found out
         about).
 
-        Process:
-        For each key in storage, get k closest nodes.  If newnode is closer
-        than the furtherst in that list, and the node for this server
-        is closer than the closest in that list, then store the key/value
-        on the new node (per section 2.5 of the paper)
-        """
-        ds = []
-        for key, value in self.storage.iteritems():
-            keynode = Node(digest(key))
-            neighbors = self.router.findNeighbors(keynode)
-            if len(neighbors) > 0:
-                newNodeClose = node.distanceTo(keynode) < neighbors[-1].distanceTo(keynode)
-                thisNodeClosest = self.sourceNode.distanceTo(keynode) < neighbors[0].distanceTo(keynode)
-            if len(neighbors) == 0 or (newNodeClose and thisNodeClosest):
-                ds.append(self.callStore(node, key, value))
-        return defer.gatherResults(ds)
+        The keys are worked out and sent in the background by self.handoff;
+        see L{HandoffScheduler}.  Returns whether a handoff was queued.
+        """
+        return self.handoff.schedule(node)
+
+    def forgetPeer(self, address):
+        """
+        Drop the contacts, version and round trip times we have for the peer
+        at address, which has left.  Whatever comes back there may be
+        running another release.
+        """
+        self.versions.pop(address, None)
+        self.rtt.forget(address)
+        self.router.removeContactsAt(address)
+
+    def welcomeNode(self, node):
+        """
+        Add node to the routing table and, if it's new to us, hand it the
+        keys it should be storing.
+        """
+        isNew = self.router.isNewNode(node)
+        self.router.addContact(node)
+        if isNew:
+            self.transferKeyValues(node)
 
     def handleCallResponse(self, result, node):
         """
@@ -108,9 +477,9 @@ class KademliaProtocol(RPCProtocol):
         """
         if result[0]:
             self.log.info("got response from %s, adding to router" % node)
-            self.router.addContact(node)
-            if self.router.isNewNode(node):
-                self.transferKeyValues(node)
+            self.welcomeNode(node)
+            if (node.ip, node.port) not in self.versions:
+                self.callVersion(node)
         else:
             self.log.debug("no response from %s, removing from router" % node)
             self.router.removeContact(node)
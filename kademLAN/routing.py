@@ -1,16 +1,62 @@
-import heapq
 import time
-import operator
+from bisect import bisect_left, insort
 from collections import OrderedDict
 
-from kademLAN.utils import OrderedSet, sharedPrefix
+
+class ReplacementCache(object):
+    """
+    Contacts waiting for room in a full L{KBucket}, keyed by node id and
+    ordered from least to most recently seen.  Holds at most maxsize nodes,
+    dropping the least recently seen one to make room.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.nodes = OrderedDict()
+
+    def push(self, node):
+        """
+        Add a node, or mark it as the most recently seen if it's already
+        here.
+        """
+        if node.id in self.nodes:
+            self.nodes.move_to_end(node.id)
+        elif len(self.nodes) >= self.maxsize:
+            self.nodes.popitem(last=False)
+        self.nodes[node.id] = node
+
+    def pop(self):
+        """
+        Remove and return the most recently seen node.
+        """
+        return self.nodes.popitem()[1]
+
+    def remove(self, node):
+        self.nodes.pop(node.id, None)
+
+    def __contains__(self, node):
+        return node.id in self.nodes
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def __len__(self):
+        return len(self.nodes)
 
 
 class KBucket(object):
-    def __init__(self, rangeLower, rangeUpper, ksize):
+    def __init__(self, rangeLower, rangeUpper, ksize, replacementSize=None):
+        """
+        @param replacementSize: The most replacement nodes to keep around
+        once the bucket is full.  Defaults to ksize.
+        """
         self.range = (rangeLower, rangeUpper)
         self.nodes = OrderedDict()
-        self.replacementNodes = OrderedSet()
+        self.replacementSize = replacementSize or ksize
+        self.replacementNodes = ReplacementCache(self.replacementSize)
+        # when each node was last heard from, and the node whose liveness
+        # is currently being checked (see RoutingTable.probeHead)
+        self.lastSeen = {}
+        self.probing = None
         self.touchLastUpdated()
         self.ksize = ksize
 
@@ -21,23 +67,36 @@ class KBucket(object):
         return list(self.nodes.values())
 
     def split(self):
-        midpoint = self.range[1] - ((self.range[1] - self.range[0]) / 2)
-        one = KBucket(self.range[0], midpoint, self.ksize)
-        two = KBucket(midpoint + 1, self.range[1], self.ksize)
+        midpoint = self.range[1] - ((self.range[1] - self.range[0]) // 2)
+        one = KBucket(self.range[0], midpoint, self.ksize, self.replacementSize)
+        two = KBucket(midpoint + 1, self.range[1], self.ksize, self.replacementSize)
         for node in list(self.nodes.values()):
             bucket = one if node.long_id <= midpoint else two
             bucket.nodes[node.id] = node
+            bucket.lastSeen[node.id] = self.lastSeen.get(node.id, 0)
+        for node in self.replacementNodes:
+            bucket = one if node.long_id <= midpoint else two
+            bucket.replacementNodes.push(node)
         return (one, two)
 
     def removeNode(self, node):
+        """
+        Remove a C{Node} from the C{KBucket}.  If a replacement node is
+        promoted in its place, it is returned.
+        """
+        # a node that's gone shouldn't be promoted later either
+        self.replacementNodes.remove(node)
         if node.id not in self.nodes:
-            return
+            return None
 
         # delete node, and see if we can add a replacement
         del self.nodes[node.id]
+        self.lastSeen.pop(node.id, None)
         if len(self.replacementNodes) > 0:
             newnode = self.replacementNodes.pop()
             self.nodes[newnode.id] = newnode
+            return newnode
+        return None
 
     def hasInRange(self, node):
         return self.range[0] <= node.long_id <= self.range[1]
@@ -57,15 +116,24 @@ class KBucket(object):
             del self.nodes[node.id]
             self.nodes[node.id] = node
         elif len(self) < self.ksize:
+            self.replacementNodes.remove(node)
             self.nodes[node.id] = node
         else:
             self.replacementNodes.push(node)
             return False
+        self.lastSeen[node.id] = time.time()
         return True
 
     def depth(self):
-        sp = sharedPrefix([n.id for n in list(self.nodes.values())])
-        return len(sp)
+        """
+        Number of leading bits shared by the ids of every node in the bucket.
+        """
+        nodes = self.getNodes()
+        first = nodes[0]
+        differing = 0
+        for node in nodes[1:]:
+            differing |= first.long_id ^ node.long_id
+        return len(first.id) * 8 - differing.bit_length()
 
     def head(self):
         return list(self.nodes.values())[0]
@@ -109,25 +177,97 @@ class TableTraverser(object):
         raise StopIteration
 
 
+class ContactIndex(object):
+    """
+    Every contact in a routing table, kept sorted by id so that the exact k
+    nearest contacts to any id (by XOR distance) can be found without
+    walking the buckets.
+    """
+    def __init__(self):
+        self.ids = []
+        self.nodes = {}
+
+    def add(self, node):
+        if node.long_id not in self.nodes:
+            insort(self.ids, node.long_id)
+        self.nodes[node.long_id] = node
+
+    def remove(self, node):
+        if self.nodes.pop(node.long_id, None) is not None:
+            del self.ids[bisect_left(self.ids, node.long_id)]
+
+    def nearest(self, long_id, k, accept=None):
+        """
+        Get the k contacts closest to long_id, closest first.
+
+        Any run of sorted ids that share a prefix forms a subtree of the id
+        space.  Splitting a run on the highest bit its ids differ in gives
+        two halves where everything in the half that agrees with long_id on
+        that bit is closer than everything in the other half, so visiting
+        halves near-first yields contacts in exact XOR order.  Each split is
+        a bisect, and runs no bigger than what is still needed are taken
+        whole.
+
+        @param accept: Optional predicate; contacts for which it returns
+        False are skipped.
+        """
+        ids = self.ids
+        found = []
+        stack = [(0, len(ids))]
+        while stack and len(found) < k:
+            lo, hi = stack.pop()
+            if hi - lo <= k - len(found):
+                run = sorted(ids[lo:hi], key=lambda i: i ^ long_id)
+                nodes = [self.nodes[i] for i in run]
+                found.extend(n for n in nodes if accept is None or accept(n))
+                continue
+            bit = (ids[lo] ^ ids[hi - 1]).bit_length() - 1
+            split = (ids[lo] >> bit | 1) << bit
+            mid = bisect_left(ids, split, lo, hi)
+            if long_id >> bit & 1:
+                stack.extend([(lo, mid), (mid, hi)])
+            else:
+                stack.extend([(mid, hi), (lo, mid)])
+        return found[:k]
+
+    def __contains__(self, node):
+        return node.long_id in self.nodes
+
+    def __len__(self):
+        return len(self.ids)
+
+
 class RoutingTable(object):
-    def __init__(self, protocol, ksize, node):
+    def __init__(self, protocol, ksize, node, replacementSize=None, pingWindow=60):
         """
         @param node: The node that represents this server.  It won't
         be added to the routing table, but will be needed later to
         determine which buckets to split or not.
+        @param replacementSize: The most replacement nodes each bucket
+        keeps.  Defaults to ksize.
+        @param pingWindow: Nodes heard from within this many seconds are
+        assumed alive and aren't pinged before eviction.
         """
         self.node = node
         self.protocol = protocol
         self.ksize = ksize
+        self.replacementSize = replacementSize
+        self.pingWindow = pingWindow
         self.flush()
 
     def flush(self):
-        self.buckets = [KBucket(0, 2 ** 160, self.ksize)]
+        self.buckets = [KBucket(0, 2 ** 160, self.ksize, self.replacementSize)]
+        # sorted upper bounds of self.buckets, kept in step with it so
+        # that getBucketFor can bisect instead of scanning every bucket
+        self.bucketUppers = [self.buckets[0].range[1]]
+        self.index = ContactIndex()
 
     def splitBucket(self, index):
         one, two = self.buckets[index].split()
         self.buckets[index] = one
         self.buckets.insert(index + 1, two)
+        self.bucketUppers[index] = one.range[1]
+        self.bucketUppers.insert(index + 1, two.range[1])
 
     def getLonelyBuckets(self):
         """
@@ -138,7 +278,25 @@ class RoutingTable(object):
 
     def removeContact(self, node):
         index = self.getBucketFor(node)
-        self.buckets[index].removeNode(node)
+        promoted = self.buckets[index].removeNode(node)
+        self.index.remove(node)
+        if promoted is not None:
+            self.index.add(promoted)
+
+    def removeContactsAt(self, address):
+        """
+        Remove every contact, including replacement nodes, at the given
+        (ip, port), as when that peer is known to have left.  Returns
+        how many were removed.
+        """
+        gone = []
+        for bucket in self.buckets:
+            for node in list(bucket.getNodes()) + list(bucket.replacementNodes):
+                if (node.ip, node.port) == address:
+                    gone.append(node)
+        for node in gone:
+            self.removeContact(node)
+        return len(gone)
 
     def isNewNode(self, node):
         index = self.getBucketFor(node)
@@ -150,6 +308,7 @@ class RoutingTable(object):
 
         # this will succeed unless the bucket is full
         if bucket.addNode(node):
+            self.index.add(node)
             return
 
         # Per section 4.2 of paper, split if the bucket has the node in its range
@@ -158,23 +317,51 @@ class RoutingTable(object):
             self.splitBucket(index)
             self.addContact(node)
         else:
-            self.protocol.callPing(bucket.head())
+            self.probeHead(bucket)
+
+    def probeHead(self, bucket):
+        """
+        A full bucket has a new contact waiting in its replacement cache.
+        Per section 2.2 of the paper, ping the least recently seen node and
+        only if it fails to answer evict it in favor of the waiting contact.
+
+        At most one probe per bucket is outstanding at a time, and a head
+        that was heard from within the last pingWindow seconds is kept
+        without being pinged.
+        """
+        if bucket.probing is not None:
+            return
+        head = bucket.head()
+        if time.time() - bucket.lastSeen.get(head.id, 0) < self.pingWindow:
+            return
+        bucket.probing = head
+        d = self.protocol.callPing(head)
+        d.addBoth(self._probeDone, bucket, head)
+
+    def _probeDone(self, result, bucket, head):
+        bucket.probing = None
+        if isinstance(result, tuple) and result[0]:
+            self.addContact(head)
+        else:
+            # removing the head promotes the most recent replacement
+            self.removeContact(head)
 
     def getBucketFor(self, node):
         """
         Get the index of the bucket that the given node would fall into.
+
+        Bucket ranges are inclusive, so this is the first bucket whose upper
+        bound is not below the node's id.
         """
-        for index, bucket in enumerate(self.buckets):
-            if node.long_id < bucket.range[1]:
-                return index
+        return bisect_left(self.bucketUppers, node.long_id)
 
     def findNeighbors(self, node, k=None, exclude=None):
+        """
+        Get the k contacts closest to the given node, closest first.
+        """
         k = k or self.ksize
-        nodes = []
-        for neighbor in TableTraverser(self, node):
-            if neighbor.id != node.id and (exclude is None or not neighbor.sameHomeAs(exclude)):
-                heapq.heappush(nodes, (node.distanceTo(neighbor), neighbor))
-            if len(nodes) == k:
-                break
-
-        return list(map(operator.itemgetter(1), heapq.nsmallest(k, nodes)))
+        self.buckets[self.getBucketFor(node)].touchLastUpdated()
+
+        def accept(neighbor):
+            return neighbor.id != node.id and (exclude is None or not neighbor.sameHomeAs(exclude))
+        return self.index.nearest(node.long_id, k, accept)
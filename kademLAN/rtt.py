@@ -0,0 +1,88 @@
+"""
+Round trip time estimation for picking RPC timeouts.
+"""
+from collections import deque
+
+
+class RTTEstimator(object):
+    """
+    Keeps a smoothed round trip time and its variance for each peer address
+    and turns them into a timeout, the same way TCP computes its
+    retransmission timeout (RFC 6298).
+    """
+    # gains for the smoothed RTT and RTT variance, and the variance multiplier
+    ALPHA = 1.0 / 8
+    BETA = 1.0 / 4
+    K = 4
+
+    def __init__(self, initial=1.0, minimum=0.5, maximum=5.0, samples=256):
+        """
+        Args:
+            initial: Timeout (in seconds) for peers with no measurements yet.
+            minimum: The smallest timeout that will ever be used.
+            maximum: The largest timeout that will ever be used.
+            samples: How many of the most recent round trip times (across
+                     all peers) to keep for percentile queries.
+        """
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        # address -> [srtt, rttvar, timeout]
+        self.peers = {}
+        self.samples = deque(maxlen=samples)
+
+    def update(self, address, rtt):
+        """
+        Fold a measured round trip time (in seconds) for the given address
+        into its estimate.
+        """
+        self.samples.append(rtt)
+        estimate = self.peers.get(address)
+        if estimate is None:
+            srtt, rttvar = rtt, rtt / 2
+        else:
+            srtt, rttvar, _ = estimate
+            rttvar = (1 - self.BETA) * rttvar + self.BETA * abs(srtt - rtt)
+            srtt = (1 - self.ALPHA) * srtt + self.ALPHA * rtt
+        self.peers[address] = [srtt, rttvar, self._clamp(srtt + self.K * rttvar)]
+
+    def timedOut(self, address):
+        """
+        Back off the timeout for an address whose call went unanswered.
+        """
+        estimate = self.peers.get(address)
+        if estimate is not None:
+            estimate[2] = self._clamp(estimate[2] * 2)
+
+    def timeoutFor(self, address):
+        """
+        Get the timeout (in seconds) to use for a call to the given address.
+        """
+        estimate = self.peers.get(address)
+        if estimate is None:
+            return self.initial
+        return estimate[2]
+
+    def get(self, address):
+        """
+        Get the (srtt, rttvar, timeout) estimate for an address, or None if
+        it has never answered.
+        """
+        estimate = self.peers.get(address)
+        return tuple(estimate) if estimate is not None else None
+
+    def percentile(self, p):
+        """
+        Get the pth percentile of recently observed round trip times across
+        all peers, or None if nothing has been measured yet.
+        """
+        if len(self.samples) == 0:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+    def forget(self, address):
+        self.peers.pop(address, None)
+
+    def _clamp(self, timeout):
+        return min(self.maximum, max(self.minimum, timeout))
@@ -1,13 +1,19 @@
-import time
-
-
-from itertools import takewhile
+import heapq
+import os
+import struct
+import zlib
+import umsgpack
+from bisect import bisect_left, bisect_right, insort
+from itertools import count
 import operator
 from collections import OrderedDict
 
+from twisted.internet import reactor, threads
 from zope.interface import implementer
 from zope.interface import Interface
 
+from kademLAN.log import Logger
+
 
 class IStorage(Interface):
     """
@@ -19,6 +25,32 @@ class IStorage(Interface):
         Set a key to the given value.
         """
 
+    def set(key, value, ttl=None, age=None):
+        """
+        Set a key to the given value, to be forgotten after ttl seconds.
+        Without a ttl, or with one longer than the storage allows, the
+        storage's own limit is used.  A copy of a value written elsewhere is
+        given its age, how many seconds ago it was first written; it keeps
+        that as its birthday, and isn't kept past the storage's limit from
+        then.  Returns whether the value was stored.
+        """
+
+    def timesFor(key):
+        """
+        Return how many seconds ago key's value was first written and how
+        many it has left, or None if key isn't stored.
+        """
+
+    def start():
+        """
+        Start forgetting keys as they expire.
+        """
+
+    def stop():
+        """
+        Stop forgetting keys.
+        """
+
     def __getitem__(key):
         """
         Get the given key.  If item doesn't exist, raises C{KeyError}
@@ -39,48 +71,205 @@ class IStorage(Interface):
         Get the iterator for this storage, should yield tuple of (key, value)
         """
 
+    def iterkeysInRange(lower, upper):
+        """
+        Return a list of the keys whose ids are between lower and upper
+        (inclusive), in id order.  A key's id is the integer value of the
+        digest it is.
+        """
+
+    def countInRange(lower, upper):
+        """
+        Return how many keys have ids between lower and upper (inclusive).
+        """
+
+    def itertriplesInRange(lower, upper):
+        """
+        Return an iterator over (key, birthday, value) tuples for the keys
+        whose ids are between lower and upper (inclusive), in id order.
+        """
+
+
+class KeyIndex(object):
+    """
+    The integer ids of stored keys, kept sorted so that the keys in any id
+    range can be found or counted with a bisect rather than a scan.  Keys
+    that aren't digests as :func:`~kademLAN.utils.digest` writes them are
+    kept in storage all the same, but not indexed.
+    """
+    def __init__(self):
+        self.ids = []
+        self.keys = {}
+
+    def add(self, key):
+        long_id = keyID(key)
+        if long_id is not None and long_id not in self.keys:
+            insort(self.ids, long_id)
+            self.keys[long_id] = key
+
+    def extend(self, keys):
+        """
+        Add many keys at once, sorting once rather than inserting each.
+        """
+        for key in keys:
+            long_id = keyID(key)
+            if long_id is not None and long_id not in self.keys:
+                self.ids.append(long_id)
+                self.keys[long_id] = key
+        self.ids.sort()
+
+    def remove(self, key):
+        long_id = keyID(key)
+        if self.keys.pop(long_id, None) is not None:
+            del self.ids[bisect_left(self.ids, long_id)]
+
+    def inRange(self, lower, upper):
+        lo = bisect_left(self.ids, lower)
+        hi = bisect_right(self.ids, upper)
+        return [self.keys[i] for i in self.ids[lo:hi]]
+
+    def countInRange(self, lower, upper):
+        return bisect_right(self.ids, upper) - bisect_left(self.ids, lower)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+def keyID(key):
+    """
+    The integer id of a storage key, or None if the key isn't a digest.
+
+    Only the 40 lowercase hex digits of a digest count, so that no two keys
+    share an id: int() alone would take 'a', 'A', '0a' and '0x0a' alike.
+    """
+    if isinstance(key, str) and len(key) == 40 and HEX_DIGITS.issuperset(key):
+        return int(key, 16)
+    return None
+
+
 @implementer(IStorage)
 class ForgetfulStorage(object):
 
-    def __init__(self, ttl=604800):
+    def __init__(self, ttl=604800, clock=None, resolution=1.0):
         """
         By default, max age is a week.
+
+        Keys are forgotten by a sweep that clock runs once start is called,
+        at most once every resolution seconds, so reads never check ages.
         """
         self.data = OrderedDict()
+        self.index = KeyIndex()
         self.ttl = ttl
+        self.clock = clock or reactor
+        self.resolution = resolution
+        # (expiresAt, sequence, key); the sequence breaks ties, since keys
+        # from peers needn't be comparable with each other
+        self.expiries = []
+        self.sequence = count()
+        self.expiresAt = {}
+        self.sweeper = None
+        self.running = False
 
     def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def expiryFor(self, now, ttl=None, age=None):
+        """
+        When a value age seconds old and given ttl seconds at now is to be
+        forgotten.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        return now + min(ttl, self.ttl - max(age or 0, 0))
+
+    def set(self, key, value, ttl=None, age=None):
+        now = self.clock.seconds()
+        expiresAt = self.expiryFor(now, ttl, age)
+        if age is not None and expiresAt <= now:
+            # a copy of a value that's already had its time
+            return False
+        birthday = now - max(age or 0, 0)
         if key in self.data:
             del self.data[key]
-        self.data[key] = (time.time(), value)
-        self.cull()
+        else:
+            self.index.add(key)
+        self.data[key] = (birthday, value)
+        self.expiresAt[key] = expiresAt
+        heapq.heappush(self.expiries, (expiresAt, next(self.sequence), key))
+        # rewritten keys leave stale entries behind; drop them now and then
+        if len(self.expiries) > 2 * len(self.expiresAt) + 64:
+            self.expiries = [(at, next(self.sequence), k) for k, at in self.expiresAt.items()]
+            heapq.heapify(self.expiries)
+        self.schedule()
+        return True
+
+    def start(self):
+        self.running = True
+        self.schedule()
+
+    def stop(self):
+        self.running = False
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            self.sweeper = None
+
+    def schedule(self):
+        """
+        Make sure a sweep is due by the time the next key expires.
+        """
+        if not self.running or len(self.expiries) == 0:
+            return
+        at = max(self.expiries[0][0], self.clock.seconds() + self.resolution)
+        if self.sweeper is not None:
+            if self.sweeper.getTime() <= at:
+                return
+            self.sweeper.cancel()
+        self.sweeper = self.clock.callLater(at - self.clock.seconds(), self.sweep)
+
+    def sweep(self):
+        """
+        Forget every key whose time is up.
+        """
+        self.sweeper = None
+        now = self.clock.seconds()
+        while len(self.expiries) > 0 and self.expiries[0][0] <= now:
+            at, _, key = heapq.heappop(self.expiries)
+            if self.expiresAt.get(key) == at:
+                self.forget(key)
+        self.schedule()
 
-    def cull(self):
-        for k, v in self.iteritemsOlderThan(self.ttl):
-            self.data.popitem(last=False)
+    def forget(self, key):
+        del self.data[key]
+        del self.expiresAt[key]
+        self.index.remove(key)
 
     def get(self, key, default=None):
-        self.cull()
         if key in self.data:
-            return self[key]
+            return self.data[key][1]
         return default
 
     def __getitem__(self, key):
-        self.cull()
         return self.data[key][1]
 
+    def timesFor(self, key):
+        if key not in self.data:
+            return None
+        now = self.clock.seconds()
+        return now - self.data[key][0], self.expiresAt[key] - now
+
     def __iter__(self):
-        self.cull()
         return iter(self.data)
 
     def __repr__(self):
-        self.cull()
         return repr(self.data)
 
     def iteritemsOlderThan(self, secondsOld):
-        minBirthday = time.time() - secondsOld
-        zipped = self._tripleIterable()
-        matches = takewhile(lambda r: minBirthday >= r[1], zipped)
+        minBirthday = self.clock.seconds() - secondsOld
+        # copies keep the birthday they were written with elsewhere, so
+        # these aren't in birthday order
+        matches = filter(lambda r: minBirthday >= r[1], self._tripleIterable())
         return map(operator.itemgetter(0, 2), matches)
 
     def _tripleIterable(self):
@@ -90,7 +279,455 @@ class ForgetfulStorage(object):
         return zip(ikeys, ibirthday, ivalues)
 
     def iteritems(self):
-        self.cull()
         ikeys = iter(self.data.keys())
         ivalues = map(operator.itemgetter(1), iter(self.data.values()))
         return zip(ikeys, ivalues)
+
+    def iterkeysInRange(self, lower, upper):
+        return self.index.inRange(lower, upper)
+
+    def countInRange(self, lower, upper):
+        return self.index.countInRange(lower, upper)
+
+    def itertriplesInRange(self, lower, upper):
+        for key in self.index.inRange(lower, upper):
+            birthday, value = self.data[key]
+            yield key, birthday, value
+
+
+class MemoryBoundedStorage(ForgetfulStorage):
+    """
+    A L{ForgetfulStorage} that keeps to a cap on how many keys it holds and
+    roughly how many bytes they take up.
+
+    Keys are either owned, which this node is one of the k closest to and so
+    is meant to be storing, or cached copies it was asked to keep along the
+    way.  When a write needs room, cached copies are evicted before owned
+    keys, least recently used first, and a cached copy is refused rather
+    than evict an owned key.
+    """
+
+    # rough bookkeeping cost of a key, on top of its packed key and value
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, maxEntries=100000, maxBytes=64 * 1024 * 1024, responsible=None, **kwargs):
+        """
+        Args:
+            maxEntries: The most keys to hold.
+            maxBytes: The most bytes of keys and values to hold, approximately.
+            responsible: A function of a key that says whether this node is
+                         one of the k closest to it.  Without one every key
+                         counts as owned.  :class:`~kademLAN.network.Server`
+                         fills it in if it's left out.
+
+        Other keyword arguments are passed on to :class:`ForgetfulStorage`.
+        """
+        ForgetfulStorage.__init__(self, **kwargs)
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.responsible = responsible
+        self.owned = OrderedDict()
+        self.cached = OrderedDict()
+        # bytes held by owned (True) and cached (False) keys
+        self.poolBytes = {True: 0, False: 0}
+        self.evictions = {'owned': 0, 'cached': 0}
+        self.refused = 0
+
+    def set(self, key, value, ttl=None, age=None):
+        now = self.clock.seconds()
+        if age is not None and self.expiryFor(now, ttl, age) <= now:
+            return False
+        size = len(umsgpack.packb([key, value])) + self.ENTRY_OVERHEAD
+        owned = self.responsible is None or self.responsible(key)
+        if key in self.data:
+            # a rewrite is a use, and gives back the room the old value took
+            self.touch(key)
+            grow, extra = size - self.sizeOf(key), 0
+        else:
+            grow, extra = size, 1
+        if not self.makeRoom(key, grow, extra, owned):
+            self.refused += 1
+            return False
+        if key in self.data:
+            self.forget(key)
+        pool = self.owned if owned else self.cached
+        pool[key] = size
+        self.poolBytes[pool is self.owned] += size
+        return ForgetfulStorage.set(self, key, value, ttl, age)
+
+    def makeRoom(self, key, grow, extra, owned):
+        """
+        Evict least recently used keys other than key until there's room for
+        grow more bytes and extra more entries, taking cached copies first
+        and owned keys only if owned is True.  Returns False, having evicted
+        nothing, if there can't be room.
+        """
+        entries = len(self.data) + extra - self.maxEntries
+        needed = self.bytes + grow - self.maxBytes
+        if entries <= 0 and needed <= 0:
+            return True
+        pools = [self.cached, self.owned] if owned else [self.cached]
+        count = sum(len(pool) for pool in pools)
+        freeable = sum(self.poolBytes[pool is self.owned] for pool in pools)
+        if any(key in pool for pool in pools):
+            count, freeable = count - 1, freeable - self.sizeOf(key)
+        if entries > count or needed > freeable:
+            return False
+        for pool in pools:
+            while (entries > 0 or needed > 0) and len(pool) > 0:
+                victim = next(iter(pool))
+                if victim == key:
+                    # key was just touched, so nothing else is left here
+                    break
+                entries, needed = entries - 1, needed - pool[victim]
+                self.evictions['owned' if pool is self.owned else 'cached'] += 1
+                self.forget(victim)
+        return True
+
+    def sizeOf(self, key):
+        return self.owned[key] if key in self.owned else self.cached[key]
+
+    @property
+    def bytes(self):
+        return self.poolBytes[True] + self.poolBytes[False]
+
+    def forget(self, key):
+        owned = key in self.owned
+        self.poolBytes[owned] -= (self.owned if owned else self.cached).pop(key)
+        ForgetfulStorage.forget(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        self.touch(key)
+        return self.data[key][1]
+
+    def __getitem__(self, key):
+        value = self.data[key][1]
+        self.touch(key)
+        return value
+
+    def touch(self, key):
+        (self.owned if key in self.owned else self.cached).move_to_end(key)
+
+    def occupancy(self):
+        """
+        How full the storage is and how much it has evicted, as a C{dict}.
+        """
+        return {
+            'entries': len(self.data),
+            'maxEntries': self.maxEntries,
+            'bytes': self.bytes,
+            'maxBytes': self.maxBytes,
+            'owned': len(self.owned),
+            'cached': len(self.cached),
+            'evictedOwned': self.evictions['owned'],
+            'evictedCached': self.evictions['cached'],
+            'refused': self.refused,
+        }
+
+
+def packKey(key):
+    """
+    Keys are nearly always digest strings, which are stored as plain text
+    since that's much quicker to read back than msgpack.
+    """
+    if isinstance(key, str):
+        return b's' + key.encode('utf-8')
+    return b'm' + umsgpack.packb(key)
+
+
+def unpackKey(data):
+    if data[:1] == b's':
+        return data[1:].decode('utf-8')
+    return umsgpack.unpackb(data[1:])
+
+
+class LogStorage(ForgetfulStorage):
+    """
+    A L{ForgetfulStorage} that keeps its values on disk, so a node that
+    restarts still has its share of the keys.
+
+    Every write is appended to a log file in directory, and only where each
+    key's value sits in the log is kept in memory, so a read is one dict
+    lookup and one positioned read.  Rewritten and forgotten values are
+    dropped by rewriting the log once they take up more room than the live
+    ones, which is done in a thread while writes go on.  On close, and after
+    each compaction, the key table is saved to a hint file next to the log
+    so that startup reads the hints and only the part of the log written
+    since, rather than the whole log.
+
+    Writes are in the operating system's hands once set returns; they
+    survive the process dying, not the machine.
+    """
+
+    # crc, birthday, expiry time, key length, value length
+    RECORD = struct.Struct('>IddHI')
+    # log length the hints cover and the crc of the rest, then per key:
+    # birthday, expiry time, value offset, value length, key length
+    HINT_HEADER = struct.Struct('>4sQI')
+    HINT = struct.Struct('>ddQIH')
+    HINT_MAGIC = b'KADH'
+
+    def __init__(self, directory, minCompaction=1024 * 1024, **kwargs):
+        """
+        Args:
+            directory: Where to keep the log and hint files.  It's made if
+                       it doesn't exist.
+            minCompaction: Don't compact until at least this many bytes of
+                           the log are dead.
+
+        Other keyword arguments are passed on to :class:`ForgetfulStorage`.
+        """
+        ForgetfulStorage.__init__(self, **kwargs)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.logPath = os.path.join(directory, 'data.log')
+        self.hintPath = os.path.join(directory, 'data.hint')
+        self.minCompaction = minCompaction
+        self.fd = os.open(self.logPath, os.O_RDWR | os.O_CREAT, 0o644)
+        self.end = 0
+        self.garbage = 0
+        self.compacting = None
+        self.log = Logger(system=self)
+        self.load()
+
+    def load(self):
+        """
+        Rebuild the key table from the hints and the log written after them.
+        Keys that expired while we were down are left out.
+        """
+        size = os.fstat(self.fd).st_size
+        entries = {}
+        covered = self.readHints(size, entries)
+        offset = covered
+        while offset < size:
+            header = os.pread(self.fd, self.RECORD.size, offset)
+            if len(header) < self.RECORD.size:
+                break
+            crc, birthday, expiresAt, keyLength, valueLength = self.RECORD.unpack(header)
+            start = offset + self.RECORD.size
+            finish = start + keyLength + valueLength
+            if finish > size:
+                break
+            # only the last record can have been cut short by a crash
+            if finish == size and zlib.crc32(header[4:] + os.pread(self.fd, finish - start, start)) != crc:
+                break
+            key = unpackKey(os.pread(self.fd, keyLength, start))
+            entries.pop(key, None)
+            entries[key] = (birthday, expiresAt, start + keyLength, valueLength, keyLength)
+            offset = finish
+        if offset < size:
+            os.ftruncate(self.fd, offset)
+        self.end = offset
+
+        now = self.clock.seconds()
+        live = 0
+        for key, (birthday, expiresAt, valueOffset, valueLength, keyLength) in entries.items():
+            if expiresAt <= now:
+                continue
+            live += self.recordSize(entries[key])
+            self.data[key] = (birthday, (valueOffset, valueLength, keyLength))
+            self.expiresAt[key] = expiresAt
+            self.expiries.append((expiresAt, next(self.sequence), key))
+        heapq.heapify(self.expiries)
+        self.index.extend(self.data)
+        self.garbage = self.end - live
+
+    def readHints(self, size, entries):
+        """
+        Read the hint file into entries, in log order, and return how much
+        of the log it covers.  Hints that don't match the log are ignored.
+        """
+        try:
+            with open(self.hintPath, 'rb') as f:
+                hints = f.read()
+        except IOError:
+            return 0
+        if len(hints) < self.HINT_HEADER.size:
+            return 0
+        magic, covered, crc = self.HINT_HEADER.unpack_from(hints)
+        if magic != self.HINT_MAGIC or covered > size:
+            return 0
+        if zlib.crc32(hints[self.HINT_HEADER.size:]) != crc:
+            return 0
+        offset = self.HINT_HEADER.size
+        while offset + self.HINT.size <= len(hints):
+            birthday, expiresAt, valueOffset, valueLength, keyLength = self.HINT.unpack_from(hints, offset)
+            offset += self.HINT.size
+            key = unpackKey(hints[offset:offset + keyLength])
+            offset += keyLength
+            entries[key] = (birthday, expiresAt, valueOffset, valueLength, keyLength)
+        return covered
+
+    def writeHints(self):
+        """
+        Save the key table, so the next startup needn't read the log.
+        """
+        parts = []
+        for key, (birthday, (valueOffset, valueLength, keyLength)) in self.data.items():
+            packedKey = packKey(key)
+            parts.append(self.HINT.pack(birthday, self.expiresAt[key], valueOffset, valueLength, len(packedKey)))
+            parts.append(packedKey)
+        body = b''.join(parts)
+        tmp = self.hintPath + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.HINT_HEADER.pack(self.HINT_MAGIC, self.end, zlib.crc32(body)))
+            f.write(body)
+        os.replace(tmp, self.hintPath)
+
+    def recordSize(self, entry):
+        return self.RECORD.size + entry[-1] + entry[-2]
+
+    def append(self, key, value, birthday, expiresAt):
+        """
+        Append a record to the log and return where its value is.
+        """
+        packedKey = packKey(key)
+        packedValue = umsgpack.packb(value)
+        body = self.RECORD.pack(0, birthday, expiresAt, len(packedKey), len(packedValue))[4:] + packedKey + packedValue
+        record = struct.pack('>I', zlib.crc32(body)) + body
+        os.pwrite(self.fd, record, self.end)
+        location = (self.end + self.RECORD.size + len(packedKey), len(packedValue), len(packedKey))
+        self.end += len(record)
+        return location
+
+    def set(self, key, value, ttl=None, age=None):
+        old = self.data.get(key)
+        if not ForgetfulStorage.set(self, key, None, ttl, age):
+            return False
+        if old is not None:
+            self.garbage += self.recordSize(old[1])
+        birthday = self.data[key][0]
+        self.data[key] = (birthday, self.append(key, value, birthday, self.expiresAt[key]))
+        self.maybeCompact()
+        return True
+
+    def forget(self, key):
+        self.garbage += self.recordSize(self.data[key][1])
+        ForgetfulStorage.forget(self, key)
+
+    def sweep(self):
+        ForgetfulStorage.sweep(self)
+        self.maybeCompact()
+
+    def maybeCompact(self):
+        if self.compacting is not None:
+            return
+        if self.garbage >= self.minCompaction and self.garbage > self.end - self.garbage:
+            self.compacting = self.compact()
+
+    def compact(self):
+        """
+        Rewrite the log with only the live values in it.
+
+        The values live now are copied to a new log in a thread, and the
+        records written meanwhile are put on its end as they are before it
+        replaces the old log.  Returns a deferred that fires once it has.
+        """
+        tmp = self.logPath + '.compact'
+        src = os.open(self.logPath, os.O_RDONLY)
+        locations = [location for _, location in self.data.values()]
+        end = self.end
+
+        def swap(result):
+            fd, moved, offset = result
+            if self.fd is None:
+                # closed meanwhile
+                os.close(fd)
+                os.unlink(tmp)
+                return
+            tail = os.pread(self.fd, self.end - end, end)
+            os.pwrite(fd, tail, offset)
+            os.fsync(fd)
+            moves = dict((old[0], new) for old, new in zip(locations, moved))
+            live = 0
+            for key, (birthday, location) in self.data.items():
+                if location[0] >= end:
+                    location = (location[0] - end + offset,) + location[1:]
+                else:
+                    location = moves[location[0]]
+                self.data[key] = (birthday, location)
+                live += self.recordSize(location)
+            # the hints point into the old log, so they mustn't outlive it
+            if os.path.exists(self.hintPath):
+                os.unlink(self.hintPath)
+            os.replace(tmp, self.logPath)
+            os.close(self.fd)
+            self.fd = fd
+            self.end = offset + len(tail)
+            self.garbage = self.end - live
+            self.writeHints()
+
+        def failed(failure):
+            self.log.warning("compacting %s failed: %s" % (self.logPath, failure.getErrorMessage()))
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+        def done(result):
+            self.compacting = None
+            return result
+
+        d = threads.deferToThread(self.copyRecords, src, tmp, locations)
+        return d.addCallback(swap).addErrback(failed).addBoth(done)
+
+    def copyRecords(self, src, tmp, locations):
+        """
+        Copy the records whose values are at locations from the log open as
+        src to a new log at tmp, and sync it.  Returns the new log's
+        descriptor, where each value now is and how much was written.  Run
+        in a thread, so it touches nothing else.
+        """
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            moved, offset = [], 0
+            for valueOffset, valueLength, keyLength in locations:
+                start = valueOffset - keyLength - self.RECORD.size
+                length = self.RECORD.size + keyLength + valueLength
+                os.pwrite(fd, os.pread(src, length, start), offset)
+                moved.append((offset + self.RECORD.size + keyLength, valueLength, keyLength))
+                offset += length
+            os.fsync(fd)
+        except Exception:
+            os.close(fd)
+            raise
+        finally:
+            os.close(src)
+        return fd, moved, offset
+
+    def close(self):
+        """
+        Stop expiring keys, save the hints and close the log.
+        """
+        self.stop()
+        os.fsync(self.fd)
+        self.writeHints()
+        os.close(self.fd)
+        self.fd = None
+
+    def read(self, location):
+        return umsgpack.unpackb(os.pread(self.fd, location[1], location[0]))
+
+    def get(self, key, default=None):
+        if key in self.data:
+            return self.read(self.data[key][1])
+        return default
+
+    def __getitem__(self, key):
+        return self.read(self.data[key][1])
+
+    def __repr__(self):
+        return repr(list(self.data))
+
+    def _tripleIterable(self):
+        for key, (birthday, location) in list(self.data.items()):
+            yield key, birthday, self.read(location)
+
+    def iteritems(self):
+        for key, (_, location) in list(self.data.items()):
+            yield key, self.read(location)
+
+    def itertriplesInRange(self, lower, upper):
+        for key in self.index.inRange(lower, upper):
+            birthday, location = self.data[key]
+            yield key, birthday, self.read(location)
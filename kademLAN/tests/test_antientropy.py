@@ -0,0 +1,93 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from kademLAN.antientropy import split
+from kademLAN.protocol import KademliaProtocol
+from kademLAN.storage import ForgetfulStorage
+from kademLAN.utils import digest
+from kademLAN.tests.utils import mknode, Link
+
+
+class AntiEntropyTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.link = Link()
+        self.alice, aliceNode = self.protocol(4000)
+        self.bob, self.bobNode = self.protocol(4001)
+        self.alice.router.addContact(self.bobNode)
+        self.bob.router.addContact(aliceNode)
+        self.alice.versions[('127.0.0.1', 4001)] = 5
+        self.bob.versions[('127.0.0.1', 4000)] = 5
+
+    def protocol(self, port):
+        protocol = KademliaProtocol(mknode(), ForgetfulStorage(clock=self.clock), 20)
+        protocol.antiEntropy.clock = self.clock
+        return protocol, self.link.attach(protocol, ('127.0.0.1', port))
+
+    def test_split(self):
+        self.assertEqual(split(0, 15, 4), [(0, 3), (4, 7), (8, 11), (12, 15)])
+        self.assertEqual(split(4, 6, 4), [(4, 4), (5, 5), (6, 6)])
+
+    def test_onlyDifferencesMove(self):
+        shared = [digest(i) for i in range(500)]
+        for key in shared:
+            self.alice.storage[key] = 'same'
+            self.bob.storage[key] = 'same'
+        for i in range(3):
+            self.alice.storage[digest('alice%i' % i)] = 'alice'
+            self.bob.storage[digest('bob%i' % i)] = 'bob'
+        self.clock.advance(10)
+        self.bob.storage[shared[0]] = 'newer'
+
+        self.alice.antiEntropy.syncWith(self.bobNode)
+        self.link.flush()
+
+        self.assertEqual(dict(self.alice.storage.iteritems()), dict(self.bob.storage.iteritems()))
+        self.assertEqual(self.alice.storage[shared[0]], 'newer')
+        self.assertEqual((self.alice.antiEntropy.pushed, self.alice.antiEntropy.pulled), (3, 4))
+        # no more than the parts of the range that differed were listed
+        self.assertTrue(len(self.link.requests('merkle_entries')) <= 7)
+
+        # once in step, a session only swaps the top level hashes
+        self.alice.antiEntropy.snapshots = []
+        self.bob.antiEntropy.snapshots = []
+        sent = len(self.link.sent)
+        self.alice.antiEntropy.syncWith(self.bobNode)
+        self.link.flush()
+        self.assertEqual(len(self.link.sent) - sent, 2)
+
+    def test_budget(self):
+        for i in range(500):
+            self.alice.storage[digest(i)] = 'x' * 100
+        self.alice.antiEntropy.budget = 2000
+        self.alice.antiEntropy.syncWith(self.bobNode)
+        self.link.flush()
+        self.assertTrue(0 < len(list(self.bob.storage)) < 500)
+
+    def test_copiesKeepTheirAge(self):
+        carol, carolNode = self.protocol(4002)
+        for protocol, node in ((self.alice, carolNode), (carol, self.bobNode)):
+            protocol.router.addContact(node)
+            protocol.versions[(node.ip, node.port)] = 5
+        key = digest('key')
+        self.alice.storage[key] = 'stale'
+        self.alice.storage[digest('other')] = 'pushed'
+        self.clock.advance(100)
+        self.bob.storage[key] = 'fresh'
+        self.clock.advance(100)
+
+        # the copy carol gets is as old as alice's value, not brand new...
+        self.alice.antiEntropy.syncWith(carolNode)
+        self.link.flush()
+        self.assertEqual(carol.storage[key], 'stale')
+        for k in (key, digest('other')):
+            self.assertEqual(carol.storage.expiresAt[k], self.alice.storage.expiresAt[k])
+            self.assertEqual(carol.storage.timesFor(k), self.alice.storage.timesFor(k))
+
+        # ...so bob's later write still wins, and comes with its own expiry
+        carol.antiEntropy.syncWith(self.bobNode)
+        self.link.flush()
+        self.assertEqual(carol.storage[key], 'fresh')
+        self.assertEqual(self.bob.storage[key], 'fresh')
+        self.assertEqual(carol.storage.expiresAt[key], self.bob.storage.expiresAt[key])
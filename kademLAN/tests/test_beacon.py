@@ -0,0 +1,137 @@
+from functools import partial
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from kademLAN.beacon import BeaconDiscover, packBeacon, unpackBeacon
+from kademLAN.network import Server
+from kademLAN.tests.utils import mknode
+
+
+class Transport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, address):
+        self.written.append((data, address))
+
+
+class BeaconDiscoverTest(unittest.TestCase):
+    def setUp(self):
+        self.joined, self.left, self.ids = [], [], []
+        self.discover = BeaconDiscover(8468, self.peerJoined, self.left.append)
+        self.discover.transport = Transport()
+        self.other = BeaconDiscover(8469)
+
+    def peerJoined(self, addr, nodeID, version):
+        self.joined.append(addr)
+        self.ids.append((nodeID, version))
+
+    def test_packBeacon(self):
+        data = packBeacon(self.other.identity, 8469)
+        # the same 22 bytes pyre's struct 'cccb16sH' with htons gives
+        self.assertEqual(len(data), 22)
+        self.assertEqual(data[:4], b'ZRE\x01')
+        self.assertEqual(data[-2:], b'\x21\x15')
+        self.assertEqual(unpackBeacon(data), (self.other.identity, 8469, None, None))
+        self.assertRaises(ValueError, unpackBeacon, b'ZRE\x02' + data[4:])
+        self.assertRaises(ValueError, unpackBeacon, data[:10])
+
+    def test_joinAndLeave(self):
+        beacon = packBeacon(self.other.identity, 8469)
+        self.discover.datagramReceived(beacon, ('10.0.0.2', 5670))
+        self.discover.datagramReceived(beacon, ('10.0.0.2', 5670))
+        self.assertEqual(self.joined, [('10.0.0.2', 8469)])
+        self.assertEqual(self.discover.get_peers(), [('10.0.0.2', 8469)])
+
+        self.discover.datagramReceived(packBeacon(self.other.identity, 0), ('10.0.0.2', 5670))
+        self.assertEqual(self.left, [('10.0.0.2', 8469)])
+        self.assertEqual(self.discover.get_peers(), [])
+
+    def test_beaconCarriesNodeID(self):
+        nodeID = mknode().id
+        data = packBeacon(self.other.identity, 8469, nodeID, 5)
+        self.assertEqual(len(data), 44)
+        self.assertEqual(unpackBeacon(data), (self.other.identity, 8469, nodeID, 5))
+        self.discover.datagramReceived(data, ('10.0.0.2', 5670))
+        self.assertEqual(self.ids, [(nodeID, 5)])
+
+        # something else tacked on by another ZRE speaker is ignored
+        self.discover.datagramReceived(packBeacon(self.discover.identity, 8470) + b'X' * 21, ('10.0.0.3', 5670))
+        foreign = BeaconDiscover(8471)
+        self.discover.datagramReceived(packBeacon(foreign.identity, 8471) + b'X' * 21, ('10.0.0.4', 5670))
+        self.assertEqual(self.ids, [(nodeID, 5), (None, None)])
+
+    def test_ignoresOwnAndForeignBeacons(self):
+        self.discover.datagramReceived(packBeacon(self.discover.identity, 8468), ('10.0.0.1', 5670))
+        self.discover.datagramReceived(b'not a beacon at all, no', ('10.0.0.3', 5670))
+        self.assertEqual(self.joined, [])
+
+    def test_publishesEveryInterval(self):
+        clock = task.Clock()
+        self.discover.clock = clock
+        self.discover.loop = task.LoopingCall(self.discover.publish)
+        self.discover.loop.clock = clock
+        self.discover.loop.start(self.discover.interval)
+        clock.pump([1, 1, 1])
+        beacons = self.discover.transport.written
+        self.assertEqual(len(beacons), 4)
+        self.assertEqual(beacons[0], (packBeacon(self.discover.identity, 8468), ('255.255.255.255', 5670)))
+        self.discover.loop.stop()
+
+    def test_reapsSilentPeers(self):
+        clock = task.Clock()
+        self.discover.clock = clock
+        quiet = BeaconDiscover(8470)
+        self.discover.datagramReceived(packBeacon(self.other.identity, 8469), ('10.0.0.2', 5670))
+        self.discover.datagramReceived(packBeacon(quiet.identity, 8470), ('10.0.0.3', 5670))
+        clock.advance(20)
+        self.discover.datagramReceived(packBeacon(self.other.identity, 8469), ('10.0.0.2', 5670))
+        clock.advance(20)
+        self.discover.reap()
+        self.assertEqual(self.left, [('10.0.0.3', 8470)])
+        self.assertEqual(self.discover.get_peers(), [('10.0.0.2', 8469)])
+        self.assertEqual(list(self.discover.lastSeen), [self.other.identity])
+
+
+class RestartTest(unittest.TestCase):
+    """
+    A peer that restarts at the same address beacons with a new identity.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.server = Server(8468, discovery=partial(BeaconDiscover, clock=self.clock))
+        self.server.bootstrapper.clock = self.clock
+        self.discover = self.server.discover
+        self.before, self.after = BeaconDiscover(8469), BeaconDiscover(8469)
+        self.beacon = packBeacon(self.before.identity, 8469, mknode().id, 5)
+
+    def test_restartedPeerStays(self):
+        self.discover.datagramReceived(self.beacon, ('10.0.0.2', 5670))
+        self.server.protocol.rtt.update(('10.0.0.2', 8469), 0.1)
+        self.clock.advance(10)
+
+        # it comes back running an older release, without the node id
+        newID = mknode().id
+        for _ in range(40):
+            self.discover.datagramReceived(packBeacon(self.after.identity, 8469, newID, 4), ('10.0.0.2', 5670))
+            self.clock.advance(1)
+            self.discover.reap()
+        self.assertEqual(self.discover.get_peers(), [('10.0.0.2', 8469)])
+        self.assertEqual(self.server.discovered_peers, set([('10.0.0.2', 8469)]))
+        contacts = self.server.protocol.router.findNeighbors(mknode())
+        self.assertEqual([n.id for n in contacts], [newID])
+        self.assertEqual(self.server.protocol.versions[('10.0.0.2', 8469)], 4)
+        self.assertEqual(self.server.protocol.rtt.get(('10.0.0.2', 8469)), None)
+
+    def test_departureForgetsPeer(self):
+        self.discover.datagramReceived(self.beacon, ('10.0.0.2', 5670))
+        self.discover.datagramReceived(packBeacon(self.before.identity, 0), ('10.0.0.2', 5670))
+        self.assertEqual(self.server.discovered_peers, set())
+        self.assertEqual(len(self.server.protocol.router.index), 0)
+        self.assertFalse(('10.0.0.2', 8469) in self.server.protocol.versions)
+
+    def test_announcesIDOnlyWhenAsked(self):
+        self.assertEqual(self.discover.nodeID, None)
+        announcing = Server(8470, discovery=partial(BeaconDiscover, clock=self.clock), announceID=True)
+        self.assertEqual(announcing.discover.nodeID, announcing.node.id)
@@ -0,0 +1,71 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+from kademLAN.bootstrap import BootstrapScheduler
+from kademLAN.protocol import KademliaProtocol
+from kademLAN.storage import ForgetfulStorage
+from kademLAN.tests.utils import mknode, Link
+
+
+class BootstrapSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.link = Link()
+        self.alice = KademliaProtocol(mknode(), ForgetfulStorage(), 3)
+        self.link.attach(self.alice, ('127.0.0.1', 4000))
+        self.peers = []
+        for i in range(8):
+            peer = KademliaProtocol(mknode(), ForgetfulStorage(), 3)
+            self.peers.append(self.link.attach(peer, ('127.0.0.1', 4001 + i)))
+        self.found = []
+        self.scheduler = BootstrapScheduler(self.alice, 3, 2, self.found.append, clock=self.clock)
+
+    def test_batchesPeers(self):
+        for peer in self.peers[:3]:
+            self.scheduler.add(peer)
+        self.scheduler.add(('127.0.0.1', 4004))
+        self.assertEqual(self.link.queue, [])
+        self.clock.advance(0.5)
+        self.link.flush()
+        self.assertEqual(self.scheduler.lookups, 1)
+        self.assertEqual(len(self.link.requests('ping')), 1)
+        self.assertEqual(len(self.found), 1)
+
+    def test_foldsPeersIntoRunningLookup(self):
+        self.scheduler.add(self.peers[0])
+        self.clock.advance(0.5)
+        self.assertTrue(self.scheduler.crawl is not None)
+        for peer in self.peers[1:4]:
+            self.scheduler.add(peer)
+        self.clock.advance(0.5)
+        self.link.flush()
+        self.assertEqual(self.scheduler.lookups, 1)
+        self.assertEqual(self.scheduler.folded, 3)
+        self.assertEqual(len(self.found), 1)
+
+    def test_backsOffWhenHealthy(self):
+        for peer in self.peers[:4]:
+            self.scheduler.add(peer)
+        self.clock.advance(0.5)
+        self.link.flush()
+        self.assertEqual(self.scheduler.interval, 10)
+
+        # a later peer goes into the routing table, but waits for the lookup
+        self.scheduler.add(self.peers[4])
+        self.clock.advance(0.5)
+        self.assertEqual(self.scheduler.lookups, 1)
+        self.assertTrue(self.peers[4] in self.alice.router.index)
+        self.scheduler.add(self.peers[5])
+        self.clock.advance(5)
+        self.assertEqual(self.scheduler.lookups, 1)
+        self.clock.advance(5)
+        self.link.flush()
+        self.assertEqual(self.scheduler.lookups, 2)
+        self.assertEqual(self.scheduler.interval, 20)
+
+    def test_discard(self):
+        self.scheduler.add(self.peers[0])
+        self.scheduler.add(('127.0.0.1', 4002))
+        self.scheduler.discard(('127.0.0.1', 4002))
+        self.scheduler.discard(('127.0.0.1', 4001))
+        self.assertEqual(self.scheduler.queued, [])
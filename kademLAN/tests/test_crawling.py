@@ -0,0 +1,127 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from kademLAN.crawling import NodeSpiderCrawl, ValueSpiderCrawl, HedgePolicy
+from kademLAN.rtt import RTTEstimator
+from kademLAN.tests.utils import mknode
+
+
+class CrawlProtocol(object):
+    """
+    Records find_* calls and leaves them outstanding until a test answers.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.stored = []
+        self.rtt = RTTEstimator()
+
+    def callFindNode(self, nodeToAsk, nodeToFind):
+        d = defer.Deferred()
+        self.calls[nodeToAsk.long_id] = d
+        return d
+
+    callFindValue = callFindNode
+
+    def callStore(self, nodeToAsk, key, value, ttl=None):
+        self.stored.append((nodeToAsk, key, value, ttl))
+        return defer.succeed((True, True))
+
+    def answer(self, long_id, result):
+        self.calls.pop(long_id).callback(result)
+
+
+def contacts(*intids):
+    return [(mknode(intid=i).id.hex(), '127.0.0.1', 3000 + i) for i in intids]
+
+
+class SpiderCrawlTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = CrawlProtocol()
+        self.peers = [mknode(intid=i, ip='127.0.0.1', port=3000 + i) for i in range(10, 15)]
+
+    def test_keepsAlphaInFlight(self):
+        spider = NodeSpiderCrawl(self.protocol, mknode(intid=0), self.peers, 5, 2)
+        spider.find()
+        self.assertEqual(sorted(self.protocol.calls), [10, 11])
+
+        # a timeout frees a slot straight away, without waiting on 11
+        self.protocol.answer(10, (False, None))
+        self.assertEqual(sorted(self.protocol.calls), [11, 12])
+
+        self.protocol.answer(12, (True, contacts(1)))
+        self.assertEqual(sorted(self.protocol.calls), [1, 11])
+
+    def test_nodeCrawlConverges(self):
+        found = []
+        spider = NodeSpiderCrawl(self.protocol, mknode(intid=0), self.peers[:2], 2, 3)
+        spider.find().addCallback(found.append)
+        self.protocol.answer(10, (True, contacts(1)))
+        self.protocol.answer(11, (True, []))
+        self.assertEqual(found, [])
+        self.protocol.answer(1, (True, contacts(10)))
+        self.assertEqual([[n.long_id for n in nodes] for nodes in found], [[1, 10]])
+
+    def test_droppedPeerNotQueriedTwice(self):
+        found = []
+        spider = NodeSpiderCrawl(self.protocol, mknode(intid=0), self.peers[:2], 2, 2)
+        spider.find().addCallback(found.append)
+        first = self.protocol.calls[11]
+        # closer nodes push 11 out while its call is still in flight
+        self.protocol.answer(10, (True, contacts(1, 2, 3, 4)))
+        for i in (1, 2, 3):
+            self.protocol.answer(i, (False, None))
+        self.protocol.answer(4, (True, contacts(11)))
+        self.assertTrue(self.protocol.calls[11] is first)
+        self.protocol.answer(11, (True, []))
+        self.assertEqual([[n.long_id for n in nodes] for nodes in found], [[4]])
+
+    def test_valueCrawlStopsOnValue(self):
+        found = []
+        spider = ValueSpiderCrawl(self.protocol, mknode(intid=0), self.peers, 5, 2)
+        spider.find().addCallback(found.append)
+        self.protocol.answer(11, (True, contacts(20)))
+        self.protocol.answer(10, (True, {'value': 'v'}))
+        self.assertEqual(found, ['v'])
+        # the nearest node without the value is asked to cache it
+        self.assertEqual(self.protocol.stored[0][0].long_id, 11)
+        # and keeps it for half as long, since 10 is nearer the key
+        self.assertEqual(self.protocol.stored[0][3], 86400 / 2)
+
+
+class HedgingTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = CrawlProtocol()
+        for _ in range(10):
+            self.protocol.rtt.update(('127.0.0.1', 1), 0.01)
+        self.protocol.rtt.update(('127.0.0.1', 1), 0.5)
+        self.peers = [mknode(intid=i, ip='127.0.0.1', port=3000 + i) for i in range(10, 15)]
+        self.policy = HedgePolicy(percentile=50, budget=1)
+        self.clock = task.Clock()
+
+    def crawl(self):
+        spider = ValueSpiderCrawl(self.protocol, mknode(intid=0), self.peers, 5, 1, self.policy)
+        spider.clock = self.clock
+        found = []
+        spider.find().addCallback(found.append)
+        return spider, found
+
+    def test_hedgeWins(self):
+        spider, found = self.crawl()
+        self.assertEqual(sorted(self.protocol.calls), [10])
+        self.clock.advance(0.01)
+        self.assertEqual(sorted(self.protocol.calls), [10, 11])
+        self.assertEqual(self.policy.fired, 1)
+
+        self.protocol.answer(11, (True, {'value': 'v'}))
+        self.assertEqual(found, ['v'])
+        self.assertEqual(self.policy.won, 1)
+
+        # the budget is spent, and nothing is left scheduled
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_fastAnswerCancelsHedge(self):
+        spider, found = self.crawl()
+        self.protocol.answer(10, (True, {'value': 'v'}))
+        self.clock.advance(1)
+        self.assertEqual(self.policy.fired, 0)
+        self.assertEqual(found, ['v'])
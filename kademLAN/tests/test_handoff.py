@@ -0,0 +1,107 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from kademLAN.handoff import HandoffScheduler
+from kademLAN.node import Node
+from kademLAN.routing import RoutingTable
+from kademLAN.storage import ForgetfulStorage
+
+
+def nibble(n, low=0):
+    """
+    A node whose id has n as its top four bits.
+    """
+    return Node(((n << 156) + low).to_bytes(20, 'big'), '127.0.0.1', 4000 + n)
+
+
+def key(n, low=0):
+    return nibble(n, low).id.hex()
+
+
+class HandoffProtocol(object):
+    def __init__(self, ksize):
+        self.sourceNode = nibble(0)
+        self.router = RoutingTable(self, ksize, self.sourceNode)
+        self.storage = ForgetfulStorage()
+        self.calls = []
+
+    def callStoreMany(self, nodeToAsk, items, times=None):
+        d = defer.Deferred()
+        self.calls.append((nodeToAsk, items, d))
+        return d
+
+    def answer(self, ok=True):
+        nodeToAsk, items, d = self.calls.pop(0)
+        d.callback(dict((k, ok) for k in items))
+
+    def fail(self):
+        nodeToAsk, items, d = self.calls.pop(0)
+        d.errback(RuntimeError("unsendable"))
+
+
+class HandoffSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.protocol = HandoffProtocol(2)
+        self.newNode = nibble(0x2)
+        for node in (nibble(0x8), nibble(0xC), self.newNode):
+            self.protocol.router.addContact(node)
+
+    def scheduler(self, **kwargs):
+        return HandoffScheduler(self.protocol, 2, clock=self.clock, **kwargs)
+
+    def test_sendsOnlyKeysNodeShouldHave(self):
+        for n in (0x1, 0x3, 0x9, 0xF):
+            self.protocol.storage[key(n)] = n
+        self.protocol.storage['not a digest'] = 'ignored'
+        self.scheduler().schedule(self.newNode)
+
+        # 0x9 and 0xf have closer nodes than us to hand them over
+        node, items, d = self.protocol.calls[0]
+        self.assertEqual(node, self.newNode)
+        self.assertEqual(items, {key(0x1): 0x1, key(0x3): 0x3})
+
+    def test_dedupesRediscoveredNodes(self):
+        self.protocol.storage[key(0x3)] = 'value'
+        scheduler = self.scheduler(cooldown=60)
+        self.assertTrue(scheduler.schedule(self.newNode))
+        self.assertFalse(scheduler.schedule(self.newNode))
+        self.protocol.answer()
+        self.assertFalse(scheduler.schedule(self.newNode))
+
+        self.clock.advance(61)
+        self.assertTrue(scheduler.schedule(self.newNode))
+
+    def test_budgets(self):
+        for low in range(10):
+            self.protocol.storage[key(0x3, low)] = 'x' * 100
+        scheduler = self.scheduler(rate=120, concurrency=2, batchSize=1)
+        scheduler.schedule(self.newNode)
+        # the first batch spends the whole second's budget
+        self.assertEqual(len(self.protocol.calls), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.protocol.calls), 2)
+        self.clock.advance(1)
+        # no more than two batches in flight, whatever the budget
+        self.assertEqual(len(self.protocol.calls), 2)
+        self.protocol.answer()
+        self.assertEqual(len(self.protocol.calls), 2)
+
+    def test_dropsUnreachableNode(self):
+        for low in range(3):
+            self.protocol.storage[key(0x3, low)] = 'value'
+        scheduler = self.scheduler(batchSize=1, concurrency=1)
+        scheduler.schedule(self.newNode)
+        self.protocol.answer(ok=False)
+        self.assertEqual(self.protocol.calls, [])
+        self.assertEqual(scheduler.pending, {})
+
+    def test_failedCallFreesSlot(self):
+        for low in range(3):
+            self.protocol.storage[key(0x3, low)] = 'value'
+        scheduler = self.scheduler(batchSize=1, concurrency=1)
+        scheduler.schedule(self.newNode)
+        self.protocol.fail()
+        self.assertEqual(scheduler.inflight, 0)
+        self.assertEqual(scheduler.pending, {})
+        self.assertEqual(len(self.flushLoggedErrors()), 0)
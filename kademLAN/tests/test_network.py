@@ -0,0 +1,130 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from kademLAN.beacon import BeaconDiscover
+from kademLAN.network import Server
+from kademLAN.node import Node
+from kademLAN.storage import MemoryBoundedStorage
+from kademLAN.tests.test_protocol import LegacyProtocol
+from kademLAN.tests.utils import Link
+from kademLAN.utils import digest
+
+
+class BatchedServerTest(unittest.TestCase):
+    """
+    Servers joined by a L{Link}, each knowing all of the others.
+    """
+    def setUp(self):
+        self.link = Link()
+        self.servers = [Server(4000 + i, ksize=3, alpha=2, discovery=BeaconDiscover) for i in range(8)]
+        nodes = [self.link.attach(s.protocol, ('127.0.0.1', s.port)) for s in self.servers]
+        for server in self.servers:
+            for node in nodes:
+                if node.id != server.node.id:
+                    server.protocol.router.addContact(node)
+                    server.protocol.versions[(node.ip, node.port)] = 5
+
+    def single(self, name):
+        """
+        Requests for name, leaving out those for its batched form.
+        """
+        return [data for data in self.link.requests(name) if (name + 's').encode() not in data[21:40]
+                and (name + '_many').encode() not in data[21:40]]
+
+    def test_findNeighborhoodsGroupsKeys(self):
+        dkeys = [digest(i) for i in range(40)]
+        found = []
+        self.servers[0]._findNeighborhoods(dkeys).addCallback(found.append)
+        self.link.flush()
+        neighborhoods = found[0]
+        self.assertEqual(sorted(sum([members for members, _ in neighborhoods], [])), sorted(dkeys))
+        self.assertTrue(len(neighborhoods) < len(dkeys))
+        for members, nodes in neighborhoods:
+            self.assertEqual(len(nodes), 3)
+
+    def test_setManyAndGetMany(self):
+        mapping = dict(('key%i' % i, 'value%i' % i) for i in range(30))
+        stored, got = [], []
+        self.servers[0].set_many(mapping).addCallback(stored.append)
+        self.link.flush()
+        self.assertEqual(stored, [dict((key, True) for key in mapping)])
+        self.assertTrue(len(self.link.requests('store_many')) > 0)
+        self.assertEqual(self.single('store'), [])
+
+        self.servers[5].get_many(list(mapping)).addCallback(got.append)
+        self.link.flush()
+        self.assertEqual(got, [mapping])
+        self.assertTrue(len(self.link.requests('find_values')) > 0)
+        self.assertEqual(self.single('find_value'), [])
+
+    def test_getManyMissingKeysNotLookedUpAgain(self):
+        self.servers[0].set('a', 'x')
+        self.link.flush()
+        got = []
+        # keys needn't be strings, and ones every neighbor was asked for
+        # aren't looked up again
+        self.servers[5].get_many([1, 'a']).addCallback(got.append)
+        self.link.flush()
+        self.assertEqual(got, [{1: None, 'a': 'x'}])
+        self.assertEqual(self.single('find_value'), [])
+
+    def test_getManyFallsBackToGet(self):
+        self.servers[0].set('a', 'x')
+        self.link.flush()
+        # one that doesn't keep a copy itself
+        server = next(s for s in self.servers if digest('a') not in s.storage.data)
+        server.protocol.callFindValues = lambda node, keys: defer.fail(RuntimeError("broken"))
+        got = []
+        server.get_many(['a']).addCallback(got.append)
+        self.link.flush()
+        self.assertEqual(got, [{'a': 'x'}])
+        self.assertTrue(len(self.single('find_value')) > 0)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 0)
+
+    def test_refreshTable(self):
+        server = self.servers[0]
+        for bucket in server.protocol.router.buckets:
+            bucket.lastUpdated = 0
+        found = []
+        server.refreshTable().addCallback(found.append)
+        self.link.flush()
+        self.assertEqual(len(found), 1)
+        self.assertTrue(all(len(nodes) > 0 for nodes in found[0]))
+        self.assertTrue(len(self.link.requests('find_node')) > 0)
+
+    def test_legacyPeersStillServed(self):
+        legacy = self.servers[1].protocol
+        legacy.__class__ = LegacyProtocol
+        for server in self.servers:
+            server.protocol.versions.pop(('127.0.0.1', 4001), None)
+        # keys the legacy peer is the closest node to
+        nodes = [server.node for server in self.servers]
+        closest = lambda key: min(nodes, key=Node(digest(key)).distanceTo)
+        keys = [key for key in ('key%i' % i for i in range(10000)) if closest(key) is nodes[1]]
+        mapping = dict((key, 1) for key in keys[:10])
+        stored = []
+        self.servers[0].set_many(mapping).addCallback(stored.append)
+        self.link.flush()
+        # the legacy peer never answers the version request, and is sent
+        # its keys one at a time instead
+        self.link.timeOut(self.servers[0].protocol)
+        self.assertEqual(stored, [dict((key, True) for key in mapping)])
+        self.assertEqual(len(legacy.storage.data), 10)
+        self.assertEqual(len(self.single('store')), 10)
+
+
+class LoneServerTest(unittest.TestCase):
+    """
+    A server that knows no other nodes, and so only has its own storage.
+    """
+    def setUp(self):
+        self.storage = MemoryBoundedStorage(maxBytes=500)
+        self.server = Server(4100, storage=self.storage, discovery=BeaconDiscover)
+
+    def test_refusedWritesNotCounted(self):
+        results = []
+        self.server.set('a', 1).addCallback(results.append)
+        self.server.set('b', 'x' * 500).addCallback(results.append)
+        self.server.set_many({'a': 1, 'c': 'x' * 500}).addCallback(results.append)
+        self.assertEqual(results, [True, False, {'a': True, 'c': False}])
+        self.assertEqual(self.storage.refused, 2)
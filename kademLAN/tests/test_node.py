@@ -3,25 +3,34 @@ import hashlib
 
 from twisted.trial import unittest
 
-from kademLAN.node import Node, NodeHeap
+from kademLAN.node import Node, NodeHeap, CONTACTED, FAILED
 from kademLAN.tests.utils import mknode
 
 
 class NodeTest(unittest.TestCase):
     def test_longID(self):
-        rid = hashlib.sha1(str(random.getrandbits(255))).digest()
+        rid = hashlib.sha1(str(random.getrandbits(255)).encode()).digest()
         n = Node(rid)
-        self.assertEqual(n.long_id, int(rid.encode('hex'), 16))
+        self.assertEqual(n.long_id, int(rid.hex(), 16))
+        self.assertEqual(Node(rid.hex()).id, rid)
 
     def test_distanceCalculation(self):
-        ridone = hashlib.sha1(str(random.getrandbits(255)))
-        ridtwo = hashlib.sha1(str(random.getrandbits(255)))
+        ridone = hashlib.sha1(str(random.getrandbits(255)).encode())
+        ridtwo = hashlib.sha1(str(random.getrandbits(255)).encode())
 
         shouldbe = int(ridone.hexdigest(), 16) ^ int(ridtwo.hexdigest(), 16)
         none = Node(ridone.digest())
         ntwo = Node(ridtwo.digest())
         self.assertEqual(none.distanceTo(ntwo), shouldbe)
 
+    def test_intern(self):
+        rid = hashlib.sha1(b'peer').digest()
+        node = Node.intern(rid.hex(), '127.0.0.1', 8468)
+        self.assertIs(Node.intern(rid.hex(), '127.0.0.1', 8468), node)
+        self.assertIs(Node.intern(rid, '127.0.0.1', 8468), node)
+        self.assertIsNot(Node.intern(rid, '127.0.0.1', 8469), node)
+        self.assertEqual(node.id, rid)
+
 
 class NodeHeapTest(unittest.TestCase):
     def test_maxSize(self):
@@ -54,3 +63,51 @@ class NodeHeapTest(unittest.TestCase):
         for index, node in enumerate(heap):
             self.assertEqual(index + 2, node.long_id)
             self.assertTrue(index < 5)
+
+    def test_deduplicates(self):
+        heap = NodeHeap(mknode(intid=0), 3)
+        node = mknode(intid=5)
+        heap.push([node, mknode(id=node.id), node])
+        self.assertEqual(list(heap), [node])
+
+        # failed peers aren't brought back by later responses
+        heap.remove([node.id])
+        heap.push(mknode(id=node.id))
+        self.assertEqual(len(heap), 0)
+        self.assertEqual(heap.getState(node), FAILED)
+
+    def test_boundedWithMargin(self):
+        heap = NodeHeap(mknode(intid=0), 2, margin=1)
+        for d in reversed(range(1, 10)):
+            heap.push(mknode(intid=d))
+        self.assertEqual(len(heap.heap), 3)
+        self.assertEqual([n.long_id for n in heap], [1, 2])
+
+        heap.remove([heap.getIDs()[0]])
+        self.assertEqual([n.long_id for n in heap], [2, 3])
+
+    def test_droppedContactedNotReadded(self):
+        heap = NodeHeap(mknode(intid=0), 1, margin=0)
+        far, near = mknode(intid=9), mknode(intid=1)
+        heap.push([far])
+        heap.markContacted(far)
+        heap.push([near])
+        self.assertEqual(heap.getIDs(), [near.id])
+        self.assertEqual(heap.getState(far), CONTACTED)
+
+        heap.remove([near.id])
+        heap.push([far])
+        self.assertEqual(heap.getUncontacted(), [])
+
+    def test_states(self):
+        heap = NodeHeap(mknode(intid=0), 2)
+        one, two = mknode(intid=1), mknode(intid=2)
+        heap.push([one, two])
+        heap.markContacted(one)
+        self.assertEqual(heap.getUncontacted(), [two])
+        self.assertEqual(heap.getNodeById(two.id), two)
+        heap.markResponded(one)
+        heap.markContacted(two)
+        self.assertFalse(heap.allResponded())
+        heap.markResponded(two)
+        self.assertTrue(heap.allResponded())
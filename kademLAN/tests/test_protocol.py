@@ -0,0 +1,153 @@
+from twisted.trial import unittest
+
+from kademLAN.crawling import RPCFindResponse
+from kademLAN.protocol import KademliaProtocol, MAX_PAYLOAD, PROTOCOL_VERSION, chunked, packedSize
+from kademLAN.storage import ForgetfulStorage
+from kademLAN.utils import digest
+from kademLAN.tests.utils import mknode, Link
+
+
+class LegacyProtocol(KademliaProtocol):
+    """
+    A peer from before the batched RPCs, which ignores them.
+    """
+    rpc_version = None
+    rpc_store_many = None
+    rpc_find_values = None
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.link = Link()
+        self.alice = KademliaProtocol(mknode(), ForgetfulStorage(), 20)
+        self.link.attach(self.alice, ('127.0.0.1', 4000))
+
+    def peer(self, protocolClass=KademliaProtocol):
+        bob = protocolClass(mknode(), ForgetfulStorage(), 20)
+        return bob, self.link.attach(bob, ('127.0.0.1', 4001))
+
+    def test_chunked(self):
+        items = [['k%i' % i, 'v' * 100] for i in range(100)]
+        chunks = list(chunked(items, 1000))
+        self.assertEqual(sum(chunks, []), items)
+        self.assertTrue(all(packedSize(chunk) <= 1000 for chunk in chunks))
+        # something too big to fit still goes, on its own
+        self.assertEqual(list(chunked(['x' * 2000], 1000)), [['x' * 2000]])
+
+    def test_storeManySplitsAtDatagramLimit(self):
+        bob, bobNode = self.peer()
+        items = dict(('key%i' % i, 'v' * 300) for i in range(100))
+        stored = []
+        self.alice.callStoreMany(bobNode, items).addCallback(stored.append)
+        self.link.flush()
+
+        self.assertEqual(stored, [dict((key, True) for key in items)])
+        self.assertEqual(dict(bob.storage.iteritems()), items)
+        requests = self.link.requests('store_many')
+        self.assertTrue(1 < len(requests) < 10)
+        self.assertTrue(all(len(data) <= MAX_PAYLOAD + 21 for data in requests))
+
+    def test_findValuesAsksAgainForMore(self):
+        bob, bobNode = self.peer()
+        for i in range(50):
+            bob.storage['key%i' % i] = 'v' * 500
+        found = []
+        keys = ['key%i' % i for i in range(60)]
+        self.alice.callFindValues(bobNode, keys).addCallback(found.append)
+        self.link.flush()
+
+        self.assertEqual(found, [dict(('key%i' % i, 'v' * 500) for i in range(50))])
+        self.assertTrue(len(self.link.requests('find_values')) > 1)
+
+    def test_legacyPeerFallsBack(self):
+        bob, bobNode = self.peer(LegacyProtocol)
+        old, a, missing = digest('old'), digest('a'), digest('missing')
+        bob.storage[old] = 'value'
+        stored, found = [], []
+        self.alice.callStoreMany(bobNode, {a: 1, digest('b'): 2}).addCallback(stored.append)
+        self.link.flush()
+        # bob never answers the version request
+        self.link.timeOut(self.alice)
+
+        self.assertEqual(stored, [{a: True, digest('b'): True}])
+        self.assertEqual(bob.storage[a], 1)
+        self.assertEqual(self.alice.versions[('127.0.0.1', 4001)], 1)
+
+        self.alice.callFindValues(bobNode, [old, a, missing]).addCallback(found.append)
+        self.link.flush()
+        self.assertEqual(found, [{old: 'value', a: 1}])
+        self.assertEqual(len(self.link.requests('version')), 1)
+
+    def test_legacyPeerTimeoutNotBackedOff(self):
+        bob, bobNode = self.peer(LegacyProtocol)
+        address = ('127.0.0.1', 4001)
+        self.alice.callPing(bobNode)
+        self.link.flush()
+        timeout = self.alice.rtt.timeoutFor(address)
+        self.alice.callVersion(bobNode)
+        self.link.flush()
+        # bob ignores the version request, which says nothing of his network
+        self.link.timeOut(self.alice)
+        self.assertEqual(self.alice.versions[address], 1)
+        self.assertEqual(self.alice.rtt.timeoutFor(address), timeout)
+
+    def test_legacyPeerOversizedValue(self):
+        bob, bobNode = self.peer(LegacyProtocol)
+        self.alice.versions[('127.0.0.1', 4001)] = 1
+        stored = []
+        items = {digest('big'): 'x' * (MAX_PAYLOAD + 1), digest('small'): 'y'}
+        self.alice.callStoreMany(bobNode, items).addCallback(stored.append)
+        self.link.flush()
+        self.assertEqual(stored, [{digest('big'): False, digest('small'): True}])
+
+    def test_ttlOnlySentToVersion4Peers(self):
+        bob, bobNode = self.peer()
+        self.alice.versions[('127.0.0.1', 4001)] = 4
+        self.alice.callStoreMany(bobNode, {'a': 1}, ttl=60)
+        self.alice.callStore(bobNode, 'b', 2, ttl=60)
+        self.link.flush()
+        for key in ('a', 'b'):
+            self.assertEqual(bob.storage.expiresAt[key], bob.storage.data[key][0] + 60)
+
+        # a version 3 peer would refuse the extra argument
+        self.alice.versions[('127.0.0.1', 4001)] = 3
+        self.alice.callStore(bobNode, 'c', 3, ttl=60)
+        self.link.flush()
+        self.assertEqual(bob.storage.expiresAt['c'], bob.storage.data['c'][0] + bob.storage.ttl)
+
+    def test_storeManyReportsEachKey(self):
+        sender = ('127.0.0.1', 4002)
+        result = self.alice.rpc_store_many(sender, mknode().id.hex(), [['a', 1], ['malformed']])
+        self.assertEqual(result, [True, False])
+        self.assertEqual(self.alice.versions[sender], 2)
+
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.link = Link()
+        self.alice = KademliaProtocol(mknode(), ForgetfulStorage(), 20)
+        self.bob = KademliaProtocol(mknode(), ForgetfulStorage(), 20)
+        self.link.attach(self.alice, ('127.0.0.1', 4000))
+        self.bobNode = self.link.attach(self.bob, ('127.0.0.1', 4001))
+        for i in range(20):
+            self.bob.router.addContact(mknode(ip='10.0.0.%i' % i, port=8468))
+
+    def test_negotiatedOnFirstResponse(self):
+        self.alice.callPing(self.bobNode)
+        self.link.flush()
+        self.assertEqual(self.alice.versions[('127.0.0.1', 4001)], PROTOCOL_VERSION)
+        self.assertEqual(self.bob.versions[('127.0.0.1', 4000)], PROTOCOL_VERSION)
+
+    def test_compactFindNode(self):
+        self.alice.versions[('127.0.0.1', 4001)] = 3
+        results = []
+        self.alice.callFindNode(self.bobNode, mknode()).addCallback(results.append)
+        self.link.flush()
+        packed = results[0][1]
+        self.assertTrue(isinstance(packed, bytes))
+        self.assertEqual(len(RPCFindResponse(results[0]).getNodeList()), 20)
+
+        # an older requester sends a hex id and gets the hex tuples back
+        hexed = self.bob.rpc_find_node(('127.0.0.1', 4002), mknode().id.hex(), mknode().id.hex())
+        self.assertEqual(len(hexed), 20)
+        self.assertTrue(len(packed) * 2 < packedSize(hexed))
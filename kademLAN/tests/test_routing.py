@@ -1,6 +1,10 @@
+import random
+
 from twisted.trial import unittest
+from twisted.internet import defer
 
-from kademLAN.routing import KBucket
+from kademLAN.node import Node
+from kademLAN.routing import KBucket, RoutingTable, ContactIndex
 from kademLAN.tests.utils import mknode, FakeProtocol
 
 
@@ -49,3 +53,126 @@ class RoutingTableTest(unittest.TestCase):
         self.router.addContact(mknode())
         self.assertTrue(len(self.router.buckets), 1)
         self.assertTrue(len(self.router.buckets[0].nodes), 1)
+
+    def test_removeContactsAt(self):
+        gone = mknode(ip='10.0.0.1', port=8468)
+        stays = mknode(ip='10.0.0.1', port=8469)
+        self.router.addContact(gone)
+        self.router.addContact(stays)
+        self.assertEqual(self.router.removeContactsAt(('10.0.0.1', 8468)), 1)
+        self.assertFalse(gone in self.router.index)
+        self.assertEqual(self.router.findNeighbors(mknode()), [stays])
+
+
+class BucketIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.router = RoutingTable(None, 2, Node('%040x' % 1))
+
+    def test_getBucketForAfterSplits(self):
+        for _ in range(6):
+            self.router.splitBucket(0)
+        uppers = [b.range[1] for b in self.router.buckets]
+        self.assertEqual(self.router.bucketUppers, uppers)
+
+        for bucket in self.router.buckets:
+            for long_id in (bucket.range[0], min(bucket.range[1], 2 ** 160 - 1)):
+                node = Node('%040x' % long_id)
+                index = self.router.getBucketFor(node)
+                self.assertTrue(self.router.buckets[index].hasInRange(node))
+
+
+class ContactIndexTest(unittest.TestCase):
+    def test_nearestIsExact(self):
+        index = ContactIndex()
+        nodes = [Node('%040x' % random.getrandbits(160)) for _ in range(300)]
+        for node in nodes:
+            index.add(node)
+        for node in nodes[:50]:
+            index.remove(node)
+        nodes = nodes[50:]
+        self.assertEqual(len(index), len(nodes))
+
+        for _ in range(20):
+            target = random.getrandbits(160)
+            expected = sorted(nodes, key=lambda n: n.long_id ^ target)[:20]
+            self.assertEqual(index.nearest(target, 20), expected)
+
+    def test_nearestAccept(self):
+        index = ContactIndex()
+        nodes = [Node('%040x' % i) for i in range(10)]
+        for node in nodes:
+            index.add(node)
+        found = index.nearest(0, 3, lambda n: n.long_id % 2 == 1)
+        self.assertEqual([n.long_id for n in found], [1, 3, 5])
+
+
+class ReplacementCacheTest(unittest.TestCase):
+    def test_boundedLRU(self):
+        bucket = KBucket(0, 2 ** 32, 1, replacementSize=3)
+        bucket.addNode(mknode(intid=0))
+        nodes = [mknode(intid=x) for x in range(1, 6)]
+        for node in nodes:
+            self.assertFalse(bucket.addNode(node))
+        # the same peer seen again is touched, not duplicated
+        bucket.addNode(mknode(id=nodes[2].id))
+        self.assertEqual(len(bucket.replacementNodes), 3)
+        ids = [n.long_id for n in bucket.replacementNodes]
+        self.assertEqual(ids, [4, 5, 3])
+
+    def test_removePromotesMostRecent(self):
+        bucket = KBucket(0, 2 ** 32, 1, replacementSize=2)
+        head = mknode(intid=0)
+        bucket.addNode(head)
+        bucket.addNode(mknode(intid=1))
+        bucket.addNode(mknode(intid=2))
+        promoted = bucket.removeNode(head)
+        self.assertEqual(promoted.long_id, 2)
+        self.assertEqual(bucket.getNodes(), [promoted])
+        self.assertEqual(len(bucket.replacementNodes), 1)
+
+
+class PingProtocol(object):
+    def __init__(self):
+        self.pings = []
+
+    def callPing(self, node):
+        d = defer.Deferred()
+        self.pings.append((node, d))
+        return d
+
+
+class ProbeHeadTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = PingProtocol()
+        self.head = mknode(intid=1)
+        self.waiting = mknode(intid=2)
+
+    def fullBucket(self, pingWindow):
+        router = RoutingTable(self.protocol, 1, mknode(intid=0), pingWindow=pingWindow)
+        router.addContact(self.head)
+        bucket = router.buckets[0]
+        self.assertFalse(bucket.addNode(self.waiting))
+        return router, bucket
+
+    def test_evictsDeadHead(self):
+        router, bucket = self.fullBucket(pingWindow=0)
+        router.probeHead(bucket)
+        router.probeHead(bucket)
+        self.assertEqual(len(self.protocol.pings), 1)
+
+        self.protocol.pings[0][1].callback((False, None))
+        self.assertEqual(bucket.getNodes(), [self.waiting])
+        self.assertEqual(router.findNeighbors(self.head), [self.waiting])
+        self.assertIsNone(bucket.probing)
+
+    def test_keepsLiveHead(self):
+        router, bucket = self.fullBucket(pingWindow=0)
+        router.probeHead(bucket)
+        self.protocol.pings[0][1].callback((True, None))
+        self.assertEqual(bucket.getNodes(), [self.head])
+        self.assertTrue(self.waiting in bucket.replacementNodes)
+
+    def test_skipsRecentlySeenHead(self):
+        router, bucket = self.fullBucket(pingWindow=60)
+        router.probeHead(bucket)
+        self.assertEqual(self.protocol.pings, [])
@@ -0,0 +1,42 @@
+from twisted.trial import unittest
+
+from kademLAN.rtt import RTTEstimator
+
+
+class RTTEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        self.rtt = RTTEstimator(initial=1.0, minimum=0.01, maximum=4.0)
+        self.address = ('127.0.0.1', 8468)
+
+    def test_unknownPeerUsesInitial(self):
+        self.assertEqual(self.rtt.timeoutFor(self.address), 1.0)
+        self.assertIsNone(self.rtt.get(self.address))
+
+    def test_firstSample(self):
+        self.rtt.update(self.address, 0.1)
+        srtt, rttvar, timeout = self.rtt.get(self.address)
+        self.assertEqual(srtt, 0.1)
+        self.assertEqual(rttvar, 0.05)
+        self.assertAlmostEqual(timeout, 0.3)
+
+    def test_smoothing(self):
+        self.rtt.update(self.address, 0.1)
+        self.rtt.update(self.address, 0.2)
+        srtt, rttvar, timeout = self.rtt.get(self.address)
+        self.assertAlmostEqual(srtt, 0.1125)
+        self.assertAlmostEqual(rttvar, 0.0625)
+        self.assertAlmostEqual(timeout, 0.3625)
+
+    def test_floorAndBackoff(self):
+        self.rtt.update(self.address, 0.0001)
+        self.assertEqual(self.rtt.timeoutFor(self.address), 0.01)
+        for _ in range(20):
+            self.rtt.timedOut(self.address)
+        self.assertEqual(self.rtt.timeoutFor(self.address), 4.0)
+
+    def test_percentile(self):
+        self.assertIsNone(self.rtt.percentile(95))
+        for ms in range(1, 101):
+            self.rtt.update(self.address, ms / 1000.0)
+        self.assertEqual(self.rtt.percentile(50), 0.051)
+        self.assertEqual(self.rtt.percentile(100), 0.1)
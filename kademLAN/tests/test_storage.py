@@ -0,0 +1,244 @@
+import os
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from kademLAN.storage import ForgetfulStorage, MemoryBoundedStorage, LogStorage
+from kademLAN.utils import digest
+
+
+class ForgetfulStorageTest(unittest.TestCase):
+    def test_mixedKeysExpireTogether(self):
+        clock = task.Clock()
+        storage = ForgetfulStorage(ttl=10, clock=clock)
+        storage.start()
+        # a peer may store a key that doesn't compare with ours
+        storage.set(7, 'x')
+        storage.set('a', 'y')
+        clock.advance(10)
+        self.assertEqual(list(storage), [])
+        storage.set('b', 'z')
+        clock.advance(10)
+        self.assertEqual(list(storage), [])
+
+    def test_rangeQueries(self):
+        storage = ForgetfulStorage()
+        keys = sorted(digest(i) for i in range(100))
+        for key in keys:
+            storage[key] = 'value'
+        storage['not a digest'] = 'value'
+
+        lower, upper = int(keys[10], 16), int(keys[20], 16)
+        self.assertEqual(storage.iterkeysInRange(lower, upper), keys[10:21])
+        self.assertEqual(storage.countInRange(lower, upper), 11)
+        self.assertEqual(storage.countInRange(0, 2 ** 160 - 1), 100)
+
+        # rewriting a key doesn't index it twice
+        storage[keys[10]] = 'again'
+        self.assertEqual(storage.countInRange(lower, upper), 11)
+
+    def test_onlyDigestsIndexed(self):
+        storage = ForgetfulStorage()
+        key = digest('key')
+        others = ['a', '0a', key.upper(), '0x' + key[2:], key[:20] + '_' + key[21:], key.encode()]
+        for other in [key] + others:
+            storage[other] = other
+        self.assertEqual(storage.iterkeysInRange(0, 2 ** 160 - 1), [key])
+        self.assertEqual([storage[other] for other in others], others)
+
+        # forgetting one that looks like the digest leaves the digest be
+        storage.forget(key.upper())
+        self.assertEqual(storage.iterkeysInRange(0, 2 ** 160 - 1), [key])
+
+    def test_expiredKeysLeaveIndex(self):
+        storage = ForgetfulStorage(ttl=-1)
+        storage[digest('key')] = 'value'
+        storage.sweep()
+        self.assertEqual(storage.countInRange(0, 2 ** 160 - 1), 0)
+
+    def test_copiesKeepTheirAge(self):
+        clock = task.Clock()
+        clock.advance(1000)
+        storage = ForgetfulStorage(ttl=100, clock=clock)
+        storage.set('copy', 1, age=30)
+        storage.set('short', 2, ttl=10, age=30)
+        self.assertEqual(storage.timesFor('copy'), (30, 70))
+        self.assertEqual(storage.timesFor('short'), (30, 10))
+        self.assertEqual(storage.data['copy'][0], 970)
+        self.assertEqual(storage.timesFor('missing'), None)
+
+        # one that's outlived the limit isn't taken at all
+        self.assertFalse(storage.set('old', 3, age=100))
+        self.assertEqual(storage.get('old'), None)
+
+    def test_sweeper(self):
+        clock = task.Clock()
+        storage = ForgetfulStorage(ttl=100, clock=clock)
+        storage['default'] = 1
+        storage.set('short', 2, ttl=10)
+        storage.set('capped', 3, ttl=1000)
+        storage.start()
+
+        clock.advance(10)
+        self.assertEqual(storage.get('short'), None)
+        self.assertEqual(storage['default'], 1)
+
+        # rewriting a key starts its time again
+        clock.advance(50)
+        storage['default'] = 4
+        clock.advance(50)
+        self.assertEqual(list(storage), ['default'])
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+        storage.stop()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+class MemoryBoundedStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.owned = set()
+        self.storage = MemoryBoundedStorage(maxEntries=4, maxBytes=10000, responsible=self.owned.__contains__)
+
+    def test_evictsCachedBeforeOwned(self):
+        self.owned.update(['o1', 'o2'])
+        for key in ('o1', 'c1', 'o2', 'c2'):
+            self.storage[key] = 'value'
+        self.storage.get('c1')
+        self.owned.update(['o3', 'o4'])
+        self.storage['o3'] = 'value'
+        self.storage['o4'] = 'value'
+
+        # c2 went first as the least recently used cached copy, then c1
+        self.assertEqual(sorted(self.storage), ['o1', 'o2', 'o3', 'o4'])
+        self.assertEqual(self.storage.evictions, {'owned': 0, 'cached': 2})
+
+        # with nothing cached left, a cached copy is refused...
+        self.assertFalse(self.storage.set('c3', 'value'))
+        # ...but an owned key evicts the least recently used owned key
+        self.owned.add('o5')
+        self.assertTrue(self.storage.set('o5', 'value'))
+        self.assertNotIn('o1', list(self.storage))
+
+    def test_byteCap(self):
+        self.owned.update(['big', 'small'])
+        self.storage['small'] = 'x'
+        self.assertFalse(self.storage.set('huge', 'x' * 20000))
+        self.storage['big'] = 'x' * 9700
+        self.assertEqual(list(self.storage), ['big'])
+        occupancy = self.storage.occupancy()
+        self.assertTrue(occupancy['bytes'] <= occupancy['maxBytes'])
+        self.assertEqual(occupancy['refused'], 1)
+
+        # rewriting a key reuses its room
+        self.storage['big'] = 'y' * 9700
+        self.assertEqual(self.storage['big'], 'y' * 9700)
+
+    def test_expiryReleasesRoom(self):
+        storage = MemoryBoundedStorage(maxEntries=1, ttl=-1)
+        storage['a'] = 1
+        storage.sweep()
+        self.assertEqual(storage.occupancy()['entries'], 0)
+        self.assertEqual(storage.bytes, 0)
+
+
+class LogStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+
+    def open(self, **kwargs):
+        return LogStorage(self.directory, clock=self.clock, **kwargs)
+
+    def test_survivesRestart(self):
+        storage = self.open(ttl=100)
+        keys = [digest(i) for i in range(20)]
+        for key in keys:
+            storage[key] = {'value': key}
+        storage.set(keys[0], 'short', ttl=10)
+        storage[keys[1]] = 'rewritten'
+        storage.close()
+
+        # the hints cover the log; later writes are read from the log itself
+        storage = self.open(ttl=100)
+        storage[keys[2]] = 'after hints'
+        os.close(storage.fd)
+
+        self.clock.advance(20)
+        storage = self.open(ttl=100)
+        self.assertEqual(storage.get(keys[0]), None)
+        self.assertEqual(storage[keys[1]], 'rewritten')
+        self.assertEqual(storage[keys[2]], 'after hints')
+        self.assertEqual(storage[keys[3]], {'value': keys[3]})
+        self.assertEqual(storage.countInRange(0, 2 ** 160 - 1), 19)
+        self.assertEqual(dict(storage.iteritems())[keys[4]], {'value': keys[4]})
+        storage.close()
+
+    def test_recoversFromTornWrite(self):
+        storage = self.open()
+        storage['a'] = 1
+        storage['b'] = 2
+        os.close(storage.fd)
+        with open(os.path.join(self.directory, 'data.log'), 'r+b') as f:
+            f.truncate(os.path.getsize(f.name) - 1)
+
+        storage = self.open()
+        self.assertEqual(list(storage), ['a'])
+        storage['c'] = 3
+        self.assertEqual(storage['c'], 3)
+        storage.close()
+
+    def test_compaction(self):
+        storage = self.open(minCompaction=0)
+        for i in range(10):
+            storage['key'] = 'x' * 100
+        # it goes on in a thread while writes carry on
+        compacting = storage.compacting
+        self.assertNotEqual(compacting, None)
+        storage['key'] = 'y' * 100
+        storage['other'] = 1
+        before = storage.end
+
+        def compacted(_):
+            self.assertEqual(storage.compacting, None)
+            self.assertTrue(storage.end < before)
+            self.assertFalse(os.path.exists(os.path.join(self.directory, 'data.log.compact')))
+            self.assertEqual(storage['key'], 'y' * 100)
+            storage.close()
+            storage2 = self.open()
+            self.assertEqual(storage2['key'], 'y' * 100)
+            self.assertEqual(storage2['other'], 1)
+            storage2.close()
+        return compacting.addCallback(compacted)
+
+    def test_compactionDropsOldHints(self):
+        storage = self.open(minCompaction=10 ** 6)
+        for i in range(3):
+            storage['key'] = str(i) * 100
+        storage['other'] = 'z' * 100
+        storage.writeHints()
+        # the process dies after the new log is in place, before its hints
+        storage.writeHints = lambda: None
+        storage.minCompaction = 0
+        for i in range(3, 9):
+            storage['key'] = str(i) * 100
+
+        def compacted(_):
+            os.close(storage.fd)
+            storage2 = self.open()
+            self.assertEqual(storage2['key'], '8' * 100)
+            self.assertEqual(storage2['other'], 'z' * 100)
+            storage2.close()
+        return storage.compacting.addCallback(compacted)
+
+    def test_corruptHintsIgnored(self):
+        storage = self.open()
+        storage['a'] = 1
+        storage.close()
+        with open(os.path.join(self.directory, 'data.hint'), 'r+b') as f:
+            f.seek(-2, os.SEEK_END)
+            f.write(b'\xff\xff')
+        storage = self.open()
+        self.assertEqual(list(storage), ['a'])
+        self.assertEqual(storage['a'], 1)
+        storage.close()
@@ -1,8 +1,9 @@
 import hashlib
 
 from twisted.trial import unittest
+from twisted.internet import defer
 
-from kademLAN.utils import digest, sharedPrefix, OrderedSet
+from kademLAN.utils import digest, sharedPrefix, OrderedSet, SingleFlight
 
 
 class UtilsTest(unittest.TestCase):
@@ -35,3 +36,29 @@ class OrderedSetTest(unittest.TestCase):
         o.push('2')
         o.push('1')
         self.assertEqual(o, ['2', '1'])
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_coalesces(self):
+        flights = SingleFlight()
+        calls = []
+
+        def lookup(key):
+            calls.append(key)
+            d = defer.Deferred()
+            calls.append(d)
+            return d
+
+        results = []
+        flights.call('k', lookup, 'k').addCallback(results.append)
+        flights.call('k', lookup, 'k').addCallback(results.append)
+        flights.call('other', lookup, 'other').addCallback(results.append)
+        self.assertEqual(flights.coalesced, 1)
+        self.assertEqual(calls[0::2], ['k', 'other'])
+
+        calls[1].callback('value')
+        self.assertEqual(results, ['value', 'value'])
+
+        # once the call is done, the next one goes out again
+        flights.call('k', lookup, 'k')
+        self.assertEqual(calls[4], 'k')
@@ -0,0 +1,22 @@
+from twisted.trial import unittest
+
+from kademLAN.wire import packContacts, unpackContacts
+from kademLAN.tests.utils import mknode
+
+
+class WireTest(unittest.TestCase):
+    def test_roundTrip(self):
+        nodes = [mknode(ip='10.0.0.1', port=8468), mknode(ip='fe80::1', port=65535)]
+        data = packContacts(nodes)
+        self.assertEqual(len(data), (20 + 1 + 4 + 2) + (20 + 1 + 16 + 2))
+        self.assertEqual(unpackContacts(data), [(n.id, n.ip, n.port) for n in nodes])
+
+    def test_skipsUnpackableAddresses(self):
+        node = mknode(ip='10.0.0.1', port=1)
+        data = packContacts([mknode(ip='localhost', port=1), node])
+        self.assertEqual(unpackContacts(data), [(node.id, node.ip, node.port)])
+
+    def test_malformed(self):
+        data = packContacts([mknode(ip='10.0.0.1', port=1)])
+        self.assertRaises(ValueError, unpackContacts, data[:-1])
+        self.assertRaises(ValueError, unpackContacts, data[:20] + b'\x05' + data[21:])
@@ -15,10 +15,49 @@ def mknode(id=None, ip=None, port=None, intid=None):
     """
     if intid is not None:
         id = pack('>l', intid)
-    id = id or hashlib.sha1(str(random.getrandbits(255))).digest()
+    id = id or hashlib.sha1(str(random.getrandbits(255)).encode()).digest()
     return Node(id, ip, port)
 
 
+class Transport(object):
+    def __init__(self, link, address):
+        self.link = link
+        self.address = address
+
+    def write(self, data, address):
+        self.link.queue.append((self.address, address, data))
+
+
+class Link(object):
+    """
+    Carries datagrams between protocols, holding them until flushed.
+    """
+    def __init__(self):
+        self.queue = []
+        self.protocols = {}
+        self.sent = []
+
+    def attach(self, protocol, address):
+        protocol.transport = Transport(self, address)
+        self.protocols[address] = protocol
+        return mknode(id=protocol.sourceNode.id, ip=address[0], port=address[1])
+
+    def flush(self):
+        while len(self.queue) > 0:
+            source, dest, data = self.queue.pop(0)
+            self.sent.append(data)
+            self.protocols[dest].datagramReceived(data, source)
+
+    def timeOut(self, protocol):
+        for msgID in list(protocol._outstanding):
+            protocol._outstanding[msgID][1].cancel()
+            protocol._timeout(msgID)
+        self.flush()
+
+    def requests(self, name):
+        return [data for data in self.sent if data[:1] == b'\x00' and name.encode() in data[21:40]]
+
+
 class FakeProtocol(object):
     def __init__(self, sourceID, ksize=20):
         self.router = RoutingTable(self, ksize, Node(sourceID))
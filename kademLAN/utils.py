@@ -39,6 +39,41 @@ def deferredDict(d):
     return dl.addCallback(handle, list(d.keys()))
 
 
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls that share a key: while a call for some key
+    is in flight, further calls for the same key wait for its result rather
+    than making their own.
+    """
+
+    def __init__(self):
+        self.inflight = {}
+        self.coalesced = 0
+
+    def call(self, key, f, *args, **kwargs):
+        """
+        Call f(*args, **kwargs) unless a call for key is already in flight.
+
+        Returns:
+            A :class:`defer.Deferred` that fires with the result of whichever
+            call is made for key.
+        """
+        if key in self.inflight:
+            self.coalesced += 1
+            d = defer.Deferred()
+            self.inflight[key].append(d)
+            return d
+
+        waiters = self.inflight[key] = []
+
+        def done(result):
+            del self.inflight[key]
+            for waiter in waiters:
+                waiter.callback(result)
+            return result
+        return defer.maybeDeferred(f, *args, **kwargs).addBoth(done)
+
+
 class OrderedSet(list):
     """
     Acts like a list in all ways, except in the behavior of the :meth:`push` method.
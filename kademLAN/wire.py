@@ -0,0 +1,67 @@
+"""
+Compact encoding of contact lists for version 3 peers.
+
+Each contact is its 20 byte id, a family byte (4 or 6), the packed IPv4 or
+IPv6 address and a 2 byte port, all run together in one byte string.
+"""
+import socket
+import struct
+
+ID_LENGTH = 20
+
+FAMILIES = {
+    4: (socket.AF_INET, 4),
+    6: (socket.AF_INET6, 16),
+}
+
+PORT = struct.Struct('>H')
+
+
+def packContact(node):
+    """
+    Encode one C{Node}.  Raises C{ValueError} if its ip isn't an IPv4 or
+    IPv6 address.
+    """
+    version = 6 if ':' in node.ip else 4
+    try:
+        address = socket.inet_pton(FAMILIES[version][0], node.ip)
+    except (OSError, TypeError):
+        raise ValueError("can't pack address %r" % node.ip)
+    return node.id + bytes((version,)) + address + PORT.pack(node.port)
+
+
+def packContacts(nodes):
+    """
+    Encode a list of C{Node}s as one byte string.  Contacts whose address
+    can't be packed are left out, since they couldn't be reached anyway.
+    """
+    packed = []
+    for node in nodes:
+        try:
+            packed.append(packContact(node))
+        except ValueError:
+            continue
+    return b''.join(packed)
+
+
+def unpackContacts(data):
+    """
+    Decode a byte string from L{packContacts} into a list of
+    (id, ip, port) tuples.  Raises C{ValueError} if data is malformed.
+    """
+    contacts = []
+    offset = 0
+    while offset < len(data):
+        id_ = data[offset:offset + ID_LENGTH]
+        offset += ID_LENGTH
+        if offset >= len(data) or data[offset] not in FAMILIES:
+            raise ValueError("bad contact at offset %i" % (offset - ID_LENGTH))
+        family, size = FAMILIES[data[offset]]
+        address = data[offset + 1:offset + 1 + size]
+        offset += 1 + size
+        if offset + PORT.size > len(data):
+            raise ValueError("truncated contact list")
+        port, = PORT.unpack_from(data, offset)
+        offset += PORT.size
+        contacts.append((id_, socket.inet_ntop(family, address), port))
+    return contacts